@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+'''
+Micro-benchmark of the SQLite write path.
+Writes years of synthetic history, then the same history again as a re-scrape of unchanged data, through:
+- per row: the write path before batching, one INSERT OR REPLACE per row (the former ON CONFLICT REPLACE tables),
+  with a commit per call and per contribution detail page
+- batched replace: the same statements with executemany, in one transaction
+- compare + changelog: db_insert_webpage(), which compares the rows with the stored ones,
+  only writes the new or changed rows and records them in the changelog
+The rows/s count the rows given to the write path, "written" the rows SQLite inserted, replaced or updated, changelog included.
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dcps import DCPS  # noqa: E402
+
+
+def synthetic_history(years, funds):
+    '''
+    build the rows a scrape of each year would return: monthly contributions and details, daily balances
+    '''
+    runs = []
+    for year in range(2000, 2000 + years):
+        results = {'balance_year': [], 'contributions': [], 'contributions_detail': [], 'balance_now': []}
+        for f in range(funds):
+            results['balance_year'].append({'NAV date': '31/12/{}'.format(year - 1), 'Currency': 'EUR', 'Fund': 'Fund {} (EUR)'.format(f),
+                                            'Amount': 1000.0 * f, 'Total Units': 100.0 * f, 'Price per UNIT': 10.0})
+        day = date(year, 1, 1)
+        while day.year == year:
+            s = day.strftime('%d/%m/%Y')
+            for f in range(funds):
+                results['balance_now'].append({'NAV date': s, 'Currency': 'EUR', 'Fund': 'Fund {} (EUR)'.format(f),
+                                               'Amount': 1000.0 + day.toordinal() % 97, 'Total Units': 100.0, 'Price per UNIT': 10.0})
+            if (day + timedelta(days=1)).day == 1:   # last day of the month
+                results['contributions'].append({'Reference Date': s, 'Currency': 'EUR', 'Operation Code': 'Contribution', 'Total Amount': 1000.0})
+                page = []
+                for f in range(funds):
+                    page.append({'Operation Date': s, 'Nav Date': s, 'Fund': 'Fund {} (EUR)'.format(f), 'Exchange Rate': 1.0,
+                                 'Gross Amount Inv/Dis': 500.0, 'Fees (*)': 0.0, 'Net Amount Inv/Dis': 500.0,
+                                 'No. of Units': 50.0 + f, 'Price per Unit': 10.0})
+                results['contributions_detail'].append(page)
+            day += timedelta(days=1)
+        runs.append(results)
+    return runs
+
+
+def rows_of(dcps, results):
+    '''
+    the rows of each data table, as the former insert functions built them
+    '''
+    return [
+        ('balance_year', [[i['NAV date'], DCPS.date_to_unix(i['NAV date']), i['Currency'], i['Fund'], i['Amount'], i['Total Units'], i['Price per UNIT'], dcps.account]
+                          for i in results['balance_year']]),
+        ('contributions', [[i['Reference Date'], DCPS.date_to_unix(i['Reference Date']), i['Currency'], i['Operation Code'], i['Total Amount'], dcps.account]
+                           for i in results['contributions']]),
+        ('contributions_detail', [[[i['Operation Date'], DCPS.date_to_unix(i['Operation Date']), i['Nav Date'], DCPS.date_to_unix(i['Nav Date']), i['Fund'],
+                                    i['Exchange Rate'], i['Gross Amount Inv/Dis'], i['Fees (*)'], i['Net Amount Inv/Dis'], i['No. of Units'], i['Price per Unit'], dcps.account]
+                                   for i in page] for page in results['contributions_detail']]),
+        ('balance_now', [[i['NAV date'], DCPS.date_to_unix(i['NAV date']), i['Currency'], i['Fund'], i['Amount'], i['Total Units'], i['Price per UNIT'], dcps.account]
+                         for i in results['balance_now']]),
+    ]
+
+
+def replace_query(table):
+    return "INSERT OR REPLACE INTO {} VALUES({})".format(table, ','.join('?' * len(DCPS.COLUMNS[table])))
+
+
+def insert_per_row(dcps, results):
+    '''
+    the write path before batching: one execute per row, commit per call and per detail page
+    '''
+    c = dcps.sql_conn.cursor()
+    for table, rows in rows_of(dcps, results):
+        pages = rows if table == 'contributions_detail' else [rows]
+        for page in pages:
+            for row in page:
+                c.execute(replace_query(table), row)
+            dcps.sql_conn.commit()
+
+
+def insert_batched_replace(dcps, results):
+    '''
+    the same rows with executemany, in one transaction
+    '''
+    with dcps.sql_conn:
+        for table, rows in rows_of(dcps, results):
+            if table == 'contributions_detail':
+                rows = [row for page in rows for row in page]
+            dcps.sql_conn.executemany(replace_query(table), rows)
+
+
+def insert_compare(dcps, results):
+    # without a page cache db_insert_webpage() writes all the contribution details given
+    dcps.db_insert_webpage(dict(results, contributions_detail=[row for page in results['contributions_detail'] for row in page]))
+
+
+def count(runs):
+    return sum(len(r['balance_year']) + len(r['contributions']) + len(r['balance_now']) + sum(len(page) for page in r['contributions_detail'])
+               for r in runs)
+
+
+def bench(name, insert, runs, db_wal):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dcps = DCPS(None, '01234567', None, db_file=os.path.join(tmpdir, 'bench.db'), db_wal=db_wal)
+        for scenario in ['new history', 'unchanged re-scrape']:
+            written = dcps.sql_conn.total_changes
+            start = time.perf_counter()
+            for results in runs:
+                insert(dcps, results)
+            elapsed = time.perf_counter() - start
+            written = dcps.sql_conn.total_changes - written
+            print("  {:22} {:20} {:8.3f} s  {:10.0f} rows/s  {:8} written".format(name, scenario, elapsed, count(runs) / elapsed, written))
+        dcps.sql_conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the SQLite insert paths.')
+    parser.add_argument('--years', type=int, default=10, help='years of synthetic history (default 10)')
+    parser.add_argument('--funds', type=int, default=3, help='number of funds (default 3)')
+    args = parser.parse_args()
+
+    runs = synthetic_history(args.years, args.funds)
+    print("{} years, {} funds, {} rows".format(args.years, args.funds, count(runs)))
+    for db_wal, journal in [(False, 'rollback journal'), (True, 'WAL')]:
+        print(journal)
+        bench('per row', insert_per_row, runs, db_wal)
+        bench('batched replace', insert_batched_replace, runs, db_wal)
+        bench('compare + changelog', insert_compare, runs, db_wal)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+'''
+Offline end-to-end benchmark against the local stand-in portal.
+For each data size it runs a fresh login, the webpage update and the statement downloads,
+and reports per phase the wall time, the number of requests, the bytes served and the peak Python memory.
+The statements are only parsed when slate is installed.
+'''
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dcps import DCPS  # noqa: E402
+import portal as stand_in  # noqa: E402
+
+SIZES = [
+    # detail pages, statements
+    (12, 1),
+    (60, 5),
+    (300, 15),
+]
+
+
+def have_slate():
+    return importlib.util.find_spec('slate') is not None
+
+
+def phase(name, portal, func, *args):
+    requests, bytes_sent = portal.requests, portal.bytes_sent
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = func(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("  {:12} {:9.3f} s {:6} req {:10.1f} kB {:10.1f} kB peak".format(
+        name, elapsed, portal.requests - requests, (portal.bytes_sent - bytes_sent) / 1024, peak / 1024))
+    return result
+
+
+def run(detail_pages, statements, latency, workers):
+    portal = stand_in.Portal(detail_pages, statements, latency)
+    server, url = stand_in.start(portal)
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dcps = DCPS(url, portal.dcps_id, portal.dcps_pwd, workers=workers, db_file=os.path.join(tmpdir, 'bench.db'), docs_dir=tmpdir, state_dir=tmpdir)
+            print("{} detail pages, {} statements, {} ms latency, {} workers".format(detail_pages, statements, latency * 1000, workers))
+            phase('login', portal, dcps.web_login)
+            phase('webpage', portal, dcps.db_update_from_webpage)
+            phase('webpage again', portal, dcps.db_update_from_webpage)
+            pdfs = phase('documents', portal, dcps.web_get_documents)
+            if have_slate():
+                phase('pdf parse', portal, dcps.db_update_from_pdfs, pdfs)
+            else:
+                print("  pdf parse    skipped, slate is not installed")
+            dcps.sql_conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='End-to-end benchmark against the local stand-in DCPS portal.')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every request (default 0.05)')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='parallel detail page downloads (default 4)')
+    parser.add_argument('--detail-pages', type=int, help='only run this number of detail pages')
+    parser.add_argument('--statements', type=int, default=1, help='number of statements with --detail-pages (default 1)')
+    args = parser.parse_args()
+
+    sizes = [(args.detail_pages, args.statements)] if args.detail_pages else SIZES
+    for detail_pages, statements in sizes:
+        run(detail_pages, statements, args.latency, args.workers)
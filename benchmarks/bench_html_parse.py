@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+'''
+Benchmark of the HTML extraction on the saved fixture pages.
+Compares the lxml/XPath extraction of dcps.py with the former BeautifulSoup path,
+checks both produce the same rows and reports parse time and peak memory.
+Peak memory is measured with tracemalloc, which does not see the memory libxml2 allocates itself.
+'''
+
+import argparse
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dcps import DCPS  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def bs4_table_to_dict_array(table):
+    headers = [header.get_text().strip() for header in table.find_all("th")]
+    results = []
+    for row in table.find_all('tr'):
+        if row.td and row.td.get('colspan'):
+            continue
+        if row.th:
+            continue
+        results_row = {}
+        for i, col in enumerate(row.find_all('td')):
+            results_row[headers[i]] = col.get_text().strip()
+        if len(results_row) > 0:
+            results.append(results_row)
+    return results
+
+
+def bs4_parse_balance_page(text):
+    soup = BeautifulSoup(text, 'lxml')
+    tmp_balance_at_tds = soup.find_all('td', limit=2, string=re.compile("Balance at"))
+    year_details_table = soup.find('td', string=re.compile("Current Year Details")).parent.parent
+    results = {
+        'balance_year': DCPS.normalise_data(bs4_table_to_dict_array(tmp_balance_at_tds[0].parent.parent)),
+        'contributions': DCPS.normalise_data(bs4_table_to_dict_array(year_details_table)),
+        'balance_now': DCPS.normalise_data(bs4_table_to_dict_array(tmp_balance_at_tds[1].parent.parent))
+    }
+    return results, [ahref.get('href') for ahref in year_details_table.find_all('a')]
+
+
+def bs4_parse_detail_page(text):
+    soup = BeautifulSoup(text, 'lxml')
+    table = soup.find('th', string=re.compile("Operation Date")).find_parent('table')
+    return DCPS.normalise_data(bs4_table_to_dict_array(table))
+
+
+def bs4_parse_documents_page(text):
+    soup = BeautifulSoup(text, 'lxml')
+    return [ahref.get('href') for ahref in soup.find_all('a', string=re.compile("Individual Statement"))]
+
+
+def bs4_form_action(text, value):
+    return BeautifulSoup(text, 'lxml').find('input', value=value).parent.get('action')
+
+
+def lxml_form_action(text, value):
+    return DCPS.html_form_action(DCPS.html_parse(text), value)
+
+
+PAGES = [
+    # fixture, former path, lxml path
+    ('main.html', lambda text: bs4_form_action(text, 'MAIN-APP-I-I-IOM'), lambda text: lxml_form_action(text, 'MAIN-APP-I-I-IOM')),
+    ('balance.html', bs4_parse_balance_page, DCPS.html_parse_balance_page),
+    ('detail.html', bs4_parse_detail_page, DCPS.html_parse_detail_page),
+    ('documents.html', bs4_parse_documents_page, DCPS.html_parse_documents_page),
+]
+
+
+def measure(parse, text, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        parse(text)
+    elapsed = (time.perf_counter() - start) / rounds
+    tracemalloc.start()
+    parse(text)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the HTML extraction of the DCPS pages.')
+    parser.add_argument('--rounds', type=int, default=200, help='parses per page (default 200)')
+    args = parser.parse_args()
+
+    print("{:16} {:>12} {:>12} {:>8} {:>12} {:>12}".format('page', 'bs4 ms', 'lxml ms', 'speedup', 'bs4 peak kB', 'lxml peak kB'))
+    for fname, bs4_parse, lxml_parse in PAGES:
+        with open(os.path.join(FIXTURES, fname), 'rb') as f:     # the bytes, as dcps.py parses response.content
+            text = f.read()
+        if bs4_parse(text) != lxml_parse(text):
+            exit("ERROR: {} is not parsed identically by both paths".format(fname))
+        bs4_time, bs4_peak = measure(bs4_parse, text, args.rounds)
+        lxml_time, lxml_peak = measure(lxml_parse, text, args.rounds)
+        print("{:16} {:12.3f} {:12.3f} {:7.1f}x {:12.1f} {:12.1f}".format(fname, bs4_time * 1000, lxml_time * 1000, bs4_time / lxml_time,
+                                                                         bs4_peak / 1024, lxml_peak / 1024))
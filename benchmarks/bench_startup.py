@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+'''
+Startup benchmark, what a cron run pays before and around the actual work.
+Measures in fresh interpreters the import of the dcps module, against importing the modules it used to load eagerly,
+and the whole command line run against the local stand-in portal, with and without --quiet.
+'''
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import portal as stand_in  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# the modules the former version imported at import time
+EAGER = 'import argparse, requests, urllib3, lxml.html, tabulate, concurrent.futures, dcps_statement; '
+
+
+def timeit(cmd, runs, env=None, cwd=None):
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, env=env, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def modules(code, env):
+    out = subprocess.run([sys.executable, '-c', code + 'import sys; print(len(sys.modules))'], env=env, check=True, capture_output=True, text=True)
+    return int(out.stdout)
+
+
+def report(name, seconds, baseline=None):
+    print("  {:32} {:8.1f} ms{}".format(name, seconds * 1000, '' if baseline is None else '   {:.2f}x'.format(baseline / seconds)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the import time and the startup of a command line run.')
+    parser.add_argument('--runs', type=int, default=10, help='runs of each measure, the median is reported (default 10)')
+    parser.add_argument('--detail-pages', type=int, default=12, help='detail pages of the stand-in portal (default 12)')
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(ROOT))
+    print("import ({} runs, median)".format(args.runs))
+    python = timeit([sys.executable, '-c', 'pass'], args.runs, env)
+    report('python -c pass', python)
+    eager = timeit([sys.executable, '-c', EAGER + 'import dcps'], args.runs, env)
+    report('import dcps, eager imports', eager)
+    lazy = timeit([sys.executable, '-c', 'import dcps'], args.runs, env)
+    report('import dcps', lazy, eager)
+    print("  modules loaded: {} eager, {} lazy".format(modules(EAGER + 'import dcps; ', env), modules('import dcps; ', env)))
+
+    portal = stand_in.Portal(args.detail_pages)
+    server, url = stand_in.start(portal)
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, 'keys.py'), 'w') as f:
+                f.write('dcps_url = {!r}\ndcps_id = {!r}\ndcps_pwd = {!r}\n'.format(url, portal.dcps_id, portal.dcps_pwd))
+            env['PYTHONPATH'] += os.pathsep + tmpdir
+            env['XDG_STATE_HOME'] = tmpdir    # the saved session
+            cmd = [sys.executable, os.path.join(ROOT, 'dcps.py'), '--db', os.path.join(tmpdir, 'bench.db')]
+            subprocess.run(cmd + ['-q'], env=env, cwd=tmpdir, check=True)   # first run: login and fill the database
+            print("command line run, {} detail pages, database up to date ({} runs, median)".format(args.detail_pages, args.runs))
+            verbose = timeit(cmd, args.runs, env, tmpdir)
+            report('dcps.py', verbose)
+            quiet = timeit(cmd + ['-q'], args.runs, env, tmpdir)
+            report('dcps.py -q', quiet, verbose)
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+'''
+Regression check and throughput benchmark of the Individual Statement parser.
+Parses the extracted statement text of the corpus with dcps_statement and with the former
+chain of re.sub passes, checks both give the same contributions_detail rows and reports pages per second.
+'''
+
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import dcps_statement  # noqa: E402
+from dcps import DCPS  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'statements')
+
+
+def legacy_parse_pages(pages):
+    contributions_detail = []
+    for page in pages:
+        if 'Holdings (SUMMARY)' in page:
+            pass
+        elif 'Holdings (DETAIL)' in page:
+            page = re.sub(r'^.*Holdings \(DETAIL\)', '', page)
+            page = re.sub(r'TransactionInvestment', '', page)
+            page = re.sub(r'\x0c', '', page)
+            page = re.sub(r'TOTAL([0-9]{2}/[0-9]{2}/[0-9]{4})([A-Z]{3}[a-zA-Z ]+\([A-Z]{3}\))(-?[0-9.]+,[0-9]{3})', '', page)
+            page = re.sub(
+                r'([a-zA-Z \(\)\*]+)([0-9]{2}/[0-9]{2}/[0-9]{4})([A-Z]{3}[a-zA-Z ]+\([A-Z]{3}\))(-?[0-9.]+,[0-9]{2})([A-Z]{3})(-?[0-9.]+,[0-9]{2})(-?[0-9.]+,[0-9]{3})([0-9.]+,[0-9]{4})',
+                r'\1\t\2\t\3\t\4\t\5\t\6\t\8\t\7\n',
+                page)
+            page = page.strip('\n')
+            for line in page.split('\n'):
+                if line.startswith('TOTAL') or line == 'Operation CodeFundInvestmentTotal AmountCurrencyTransactionAmount Invested /Disinvested / AccruedPrice per Unit(NAV)ReferenceDateTotal Units':
+                    continue
+                line = line.replace('.', '').replace(',', '.')
+                items = re.split('\t', line)
+                contributions_detail.append(items)
+    results = []
+    for row in contributions_detail:
+        results.append({
+            'Operation Code': row[0], 'Operation Date': row[1], 'Nav Date': row[1], 'Fund': row[2], 'Total Amount': row[3], 'Currency': row[4],
+            'Gross Amount Inv/Dis': row[5], 'Net Amount Inv/Dis': row[5], 'Price per Unit': row[6], 'No. of Units': row[7],
+            'Exchange Rate': '1.0', 'Fees (*)': '0.0'
+        })
+    return DCPS.normalise_data(results)
+
+
+def new_parse_pages(pages):
+    return DCPS.pdf_contributions_detail_list_to_dict_array(dcps_statement.parse_pages(pages))
+
+
+def load_corpus():
+    '''
+    the statements as lists of pages, like slate.PDF returns them
+    '''
+    corpus = {}
+    for fname in sorted(glob.glob(os.path.join(CORPUS, '*.txt'))):
+        with open(fname) as f:
+            corpus[os.path.basename(fname)] = [page + '\x0c' for page in f.read().split('\x0c')[:-1]]
+    return corpus
+
+
+def pages_per_second(parse, corpus, rounds):
+    pages = sum(len(statement) for statement in corpus.values())
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for statement in corpus.values():
+            parse(statement)
+    return pages * rounds / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check and benchmark the Individual Statement parser.')
+    parser.add_argument('--rounds', type=int, default=20, help='passes over the corpus (default 20)')
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    for name, statement in corpus.items():
+        expected = legacy_parse_pages(statement)
+        if not expected or new_parse_pages(statement) != expected:
+            exit("ERROR: {} is not parsed identically by both parsers".format(name))
+    print("{} statements, {} pages, {} rows parsed identically".format(len(corpus), sum(len(s) for s in corpus.values()),
+                                                                       sum(len(legacy_parse_pages(s)) for s in corpus.values())))
+    legacy = pages_per_second(legacy_parse_pages, corpus, args.rounds)
+    new = pages_per_second(new_parse_pages, corpus, args.rounds)
+    print("former re.sub chain  {:10.0f} pages/s".format(legacy))
+    print("dcps_statement       {:10.0f} pages/s  ({:.1f}x)".format(new, new / legacy))
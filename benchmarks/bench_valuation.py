@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+'''
+Micro-benchmark of the valuation engine.
+Fills a database with decades of synthetic daily prices and monthly contributions for several accounts,
+then measures the initial load, the incremental update after one new NAV day and the full reload it avoids.
+Both can be wrong the same way, so the valuation is first checked against small hand-computed cases.
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import dcps_valuation  # noqa: E402
+from dcps import DCPS  # noqa: E402
+
+DAY = dcps_valuation.DAY
+
+
+def expect(name, got, want):
+    if not np.allclose(got, want, equal_nan=True):
+        exit("ERROR: {}: got {}, expected {}".format(name, got, want))
+
+
+def transaction(date_operation, date_nav, fund, units, price):
+    # contributions_detail columns as dcps_valuation.Valuation.apply_rows() gets them, days instead of dates
+    return {'date_operation_unix': date_operation * DAY, 'date_nav_unix': date_nav * DAY, 'fund': fund,
+            'units': units, 'amount_gross': units * price, 'price_per_unit': price}
+
+
+def check():
+    '''
+    hand-computed cases, from the database rows and incrementally
+    '''
+    # one fund: 10 units at 10 on day 0, price 11 on day 10 when 10 more units are bought, 12.1 on day 20
+    v = dcps_valuation.from_rows([(0, 0, 'F', 10.0, 100.0, 10.0), (10 * DAY, 10 * DAY, 'F', 10.0, 110.0, 11.0)], [(20 * DAY, 'F', 12.1)])
+    expect('one fund, value', v.series()['value'][[0, 9, 10, 20]], [100, 100, 220, 242])
+    expect('one fund, invested', v.series()['invested'][-1], 210)
+    expect('one fund, twr', v.twr(), 1.1 * 1.1 - 1)
+    expect('one fund, total twr', v.twr('F'), v.twr())
+    # without a flow in the period the money-weighted return is the time-weighted one, not annualised over 10 days
+    expect('one fund, mwr', v.mwr(start='1970-01-12', end='1970-01-21'), 0.1)
+    # F holds a flat 100, G is bought on day 5 but its NAV date is day 7: G is valued at the transaction price from day 5
+    rows = [transaction(0, 0, 'F', 10, 10.0), transaction(5, 7, 'G', 5, 10.0)]
+    prices = [(d * DAY, 'F', 10.0) for d in range(10)] + [(d * DAY, 'G', 10.0) for d in range(7, 10)]
+    v = dcps_valuation.from_rows([(x['date_operation_unix'], x['date_nav_unix'], x['fund'], x['units'], x['amount_gross'], x['price_per_unit']) for x in rows],
+                                 prices)
+    incremental = dcps_valuation.from_rows([], prices[:10])
+    incremental.apply_rows('contributions_detail', rows[:1])
+    incremental.refresh()
+    incremental.apply_rows('balance_now', [{'date_unix': d, 'fund': f, 'price_per_unit': p} for d, f, p in prices[10:]])
+    incremental.apply_rows('contributions_detail', rows[1:])
+    for name, x in [('operation before NAV', v), ('operation before NAV, incremental', incremental)]:
+        expect(name + ', value', x.series()['value'], [100] * 5 + [150] * 5)
+        expect(name + ', twr', [x.twr(), x.twr('F'), x.twr('G')], [0, 0, 0])
+        expect(name + ', mwr', x.mwr(), 0)
+    print("valuation checks passed")
+
+
+def fill(dcps, account, years, funds):
+    balance_now = []
+    contributions_detail = []
+    day = date(2000, 1, 1)
+    while day.year < 2000 + years:
+        s = day.strftime('%d/%m/%Y')
+        unix = DCPS.date_to_unix(s)
+        for f in range(funds):
+            price = 10.0 + (day.toordinal() * (f + 1)) % 97 / 100
+            balance_now.append([s, unix, 'EUR', 'Fund {} (EUR)'.format(f), 0.0, 0.0, price, account])
+            if day.day == 1:
+                contributions_detail.append([s, unix, s, unix, 'Fund {} (EUR)'.format(f), 1.0, 500.0, 0.0, 500.0, 500.0 / price, price, account])
+        day += timedelta(days=1)
+    c = dcps.sql_conn.cursor()
+    c.executemany("INSERT INTO balance_now VALUES(?,?,?,?,?,?,?,?)", balance_now)
+    c.executemany("INSERT INTO contributions_detail VALUES(?,?,?,?,?,?,?,?,?,?,?,?)", contributions_detail)
+    dcps.sql_conn.commit()
+    return day
+
+
+def measure(name, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    print("  {:34} {:9.4f} s".format(name, time.perf_counter() - start))
+    return result
+
+
+def run(years, funds, accounts):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dcps = DCPS(None, None, None, db_file=os.path.join(tmpdir, 'bench.db'))
+        for account in range(accounts):
+            next_day = fill(dcps, str(account), years, funds)
+        print("{} years, {} funds, {} accounts".format(years, funds, accounts))
+
+        valuations = measure('load all accounts', lambda: [dcps.db_get_valuation(str(a)) for a in range(accounts)])
+        measure('returns of all accounts', lambda: [(v.twr(), v.mwr()) for v in valuations])
+        s = next_day.strftime('%d/%m/%Y')
+        new_day = [{'NAV date': s, 'Currency': 'EUR', 'Fund': 'Fund {} (EUR)'.format(f), 'Amount': 0.0, 'Total Units': 0.0, 'Price per UNIT': 11.0}
+                   for f in range(funds)]
+
+        def incremental():
+            for a in range(accounts):
+                dcps.db_insert_balance_now(new_day, str(a))
+                dcps.db_get_valuation(str(a))
+        measure('one new NAV day, incremental', incremental)
+
+        def reload():
+            dcps.valuations = {}
+            for a in range(accounts):
+                dcps.db_get_valuation(str(a))
+        measure('one new NAV day, full reload', reload)
+        dcps.sql_conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the valuation engine on synthetic history.')
+    parser.add_argument('--years', type=int, default=30, help='years of daily history (default 30)')
+    parser.add_argument('--funds', type=int, default=5, help='funds per account (default 5)')
+    parser.add_argument('--accounts', type=int, default=10, help='number of accounts (default 10)')
+    args = parser.parse_args()
+    check()
+    run(args.years, args.funds, args.accounts)
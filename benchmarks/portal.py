@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+'''
+Local stand-in for the DCPS portal, to run the scraper offline.
+It copies the two-step login (the token-authentication form), the f-token/c-token navigation,
+the contribution detail pages and the Individual Statement downloads, and can add latency to every request.
+The pages follow the layout of the saved fixture pages, the data is synthetic.
+'''
+
+import argparse
+import hashlib
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+FUNDS = ['XXX Global Equity W (EUR)', 'YYY Global Stock Index Fund (EUR)', 'ZZZ Euro Government Bond Fund (EUR)']
+SESSION = 'JSESSIONID=0123456789abcdef'
+
+
+def number(x, decimals):
+    return '{:,.{}f}'.format(x, decimals)
+
+
+def minimal_pdf(pages):
+    '''
+    a valid PDF with one page of plain text for each string of pages
+    '''
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>',
+               None,   # the page tree, once the pages are known
+               b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for page in pages:
+        lines = page.replace('\x0c', '').split('\n')
+        text = ' T* '.join('({}) Tj'.format(line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')) for line in lines)
+        stream = 'BT /F1 8 Tf 10 TL 20 800 Td {} ET'.format(text).encode('latin-1')
+        objects.append(b'<< /Length ' + str(len(stream)).encode() + b' >>\nstream\n' + stream + b'\nendstream')
+        objects.append('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {} 0 R /Resources << /Font << /F1 3 0 R >> >> >>'.format(len(objects)).encode())
+        kids.append('{} 0 R'.format(len(objects)))
+    objects[1] = '<< /Type /Pages /Kids [{}] /Count {} >>'.format(' '.join(kids), len(kids)).encode()
+    pdf = b'%PDF-1.4\n'
+    offsets = []
+    for i, obj in enumerate(objects):
+        offsets.append(len(pdf))
+        pdf += '{} 0 obj\n'.format(i + 1).encode() + obj + b'\nendobj\n'
+    xref = len(pdf)
+    pdf += 'xref\n0 {}\n0000000000 65535 f \n'.format(len(objects) + 1).encode()
+    pdf += b''.join('{:010d} 00000 n \n'.format(offset).encode() for offset in offsets)
+    pdf += 'trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n'.format(len(objects) + 1, xref).encode()
+    return pdf
+
+
+class Portal:
+    '''
+    the data and the counters of the stand-in portal
+    '''
+    def __init__(self, detail_pages=12, statements=1, latency=0.0, dcps_id='01234567', dcps_pwd='secret'):
+        self.detail_pages = detail_pages
+        self.statements = statements
+        self.latency = latency      # seconds added to every request
+        self.dcps_id = str(dcps_id)
+        self.dcps_pwd = dcps_pwd
+        self.requests = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        with open(os.path.join(FIXTURES, 'main.html')) as f:
+            self.layout = f.read()
+        # reuse the statement corpus, cycling through it when more statements are requested
+        corpus_dir = os.path.join(FIXTURES, 'statements')
+        self.corpus = sorted(os.listdir(corpus_dir))
+        self.corpus_dir = corpus_dir
+        self.pdfs = {}
+
+    def page(self, content):
+        # the layout of the fixture pages, with the welcome text replaced by the content
+        head, tail = self.layout.split('<h1>Welcome</h1>')
+        return head.split('<form ')[0] + content + tail[tail.index('</td>'):]
+
+    def main_page(self):
+        forms = ''.join('<form name="{0}" method="post" action="/dcps/ecol/navigate.do"><input type="hidden" name="f-token" value="MAIN-APP-I-I-{0}"></form>\n'.format(c)
+                        for c in ['HOM', 'IOM', 'IPR', 'IDV'])
+        return self.page(forms + '<h1>Welcome</h1>\n<p>Welcome to the DCPS member site.</p>\n')
+
+    def balance_table(self, title, date, seed):
+        rnd = random.Random(seed)
+        s = '<table class="data" width="100%">\n<tr><th>#</th><th>Currency</th><th>Operation Code</th><th>Fund</th><th>NAV date</th><th>Total Units</th><th>Price per UNIT</th><th>Amount</th></tr>\n'
+        s += '<tr><td colspan="8" class="subtitle">Balance at {}</td></tr>\n'.format(date)
+        for fund in FUNDS:
+            units = rnd.uniform(100, 20000)
+            price = rnd.uniform(1, 300)
+            s += '<tr><td></td><td>EUR</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>\n'.format(
+                title, fund, date, number(units, 3), number(price, 3), number(units * price, 2))
+        return s + '</table>\n'
+
+    def detail_date(self, i):
+        # spread the detail pages over the days of the year
+        return '{:02d}/{:02d}/2018'.format(1 + i % 28, 1 + (i // 28) % 12)
+
+    def balance_page(self):
+        s = '<h1>MY CONTRIBUTION BALANCE</h1>\n' + self.balance_table('Previous Year Balance', '29/12/2017', 1)
+        s += '<table class="data" width="100%">\n<tr><td colspan="5" class="subtitle">Current Year Details</td></tr>\n'
+        s += '<tr><th>#</th><th>Currency</th><th>Operation Code</th><th>Total Amount</th><th>Reference Date</th></tr>\n'
+        for i in range(self.detail_pages):
+            s += '<tr><td><a href="/dcps/ecol/detail.do?id={0}">{0}</a></td><td>EUR</td><td>Contribution</td><td>{1}</td><td>{2}</td></tr>\n'.format(
+                i, number(1000 + i, 2), self.detail_date(i))
+        s += '</table>\n' + self.balance_table('Current Year Balance', '14/12/2018', 2)
+        return self.page(s)
+
+    def detail_page(self, i):
+        rnd = random.Random(i)
+        s = '<h1>CONTRIBUTION DETAILS</h1>\n<table class="data" width="100%">\n'
+        s += '<tr><th>Operation Date</th><th>Nav Date</th><th>Fund</th><th>Exchange Rate</th><th>Gross Amount Inv/Dis</th><th>Fees (*)</th><th>Net Amount Inv/Dis</th><th>No. of Units</th><th>Price per Unit</th></tr>\n'
+        amount = (1000 + i) / len(FUNDS)
+        for fund in FUNDS:
+            price = rnd.uniform(1, 300)
+            s += '<tr><td>{0}</td><td>{0}</td><td>{1}</td><td>1.000000</td><td>{2}</td><td>0.00</td><td>{2}</td><td>{3}</td><td>{4}</td></tr>\n'.format(
+                self.detail_date(i), fund, number(amount, 2), number(amount / price, 3), number(price, 4))
+        s += '<tr><td colspan="9">(*) Fees are included in the Gross Amount</td></tr>\n</table>\n'
+        return self.page(s)
+
+    def documents_page(self):
+        s = '<h1>DOCUMENTS</h1>\n<table class="data">\n<tr><th>Document</th><th>Date</th></tr>\n'
+        for i in range(self.statements):
+            s += '<tr><td><a href="/dcps/ecol/document.do?id={0}">Individual Statement {1}</a></td><td>31/03/{2}</td></tr>\n'.format(i, 2017 - i, 2018 - i)
+        s += '<tr><td><a href="/dcps/ecol/document.do?id=sip">Statement of Investment Principles</a></td><td>01/01/2018</td></tr>\n</table>\n'
+        return self.page(s)
+
+    def statement_pdf(self, i):
+        if i not in self.pdfs:
+            with open(os.path.join(self.corpus_dir, self.corpus[i % len(self.corpus)])) as f:
+                self.pdfs[i] = minimal_pdf(f.read().split('\x0c')[:-1])
+        return self.pdfs[i]
+
+
+class PortalHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive, like the real portal
+    disable_nagle_algorithm = True  # headers and body are written separately, Nagle would delay every response
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, body, content_type='text/html; charset=UTF-8', headers=None, status=200):
+        portal = self.server.portal
+        body = body.encode('utf-8') if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+        with portal.lock:
+            portal.bytes_sent += len(body)
+
+    def start(self):
+        portal = self.server.portal
+        with portal.lock:
+            portal.requests += 1
+        if portal.latency:
+            time.sleep(portal.latency)
+        url = urlsplit(self.path)
+        return portal, url.path, parse_qs(url.query)
+
+    def authenticated(self):
+        return SESSION in self.headers.get('Cookie', '')
+
+    def do_POST(self):
+        portal, path, query = self.start()
+        data = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+        if path == '/login.jsp':
+            if data.get('id', [''])[0] != portal.dcps_id or data.get('pw', [''])[0] != portal.dcps_pwd:
+                self.send('<html><body><p class="error">Invalid ID or password.</p></body></html>')
+                return
+            with open(os.path.join(FIXTURES, 'login.html')) as f:
+                # point the form to this server
+                self.send(f.read().replace('https://dcps.example.org', 'http://' + self.headers['Host']))
+        elif path == '/dcps/ecol/login.do' and data.get('token-authentication'):
+            self.send(portal.main_page(), headers={'Set-Cookie': SESSION + '; Path=/; HttpOnly'})
+        elif path == '/dcps/ecol/navigate.do' and self.authenticated():
+            if data.get('f-token') == ['MAIN-APP-I-I-IOM']:
+                self.send(portal.balance_page())
+            elif data.get('f-token') == ['MAIN-APP-I-I-IDV']:
+                self.send(portal.documents_page())
+            else:
+                self.send(portal.main_page())
+        else:
+            self.send('<html><body>Session expired</body></html>', status=403)
+
+    def do_GET(self):
+        portal, path, query = self.start()
+        if not self.authenticated():
+            self.send('<html><body>Session expired</body></html>', status=403)
+        elif path == '/dcps/ecol/main.do':
+            self.send(portal.main_page())
+        elif path == '/dcps/ecol/detail.do':
+            i = int(query['id'][0])
+            body = portal.detail_page(i).encode('utf-8')
+            etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:16])
+            if self.headers.get('If-None-Match') == etag:
+                self.send(b'', status=304, headers={'ETag': etag})
+            else:
+                self.send(body, headers={'ETag': etag})
+        elif path == '/dcps/ecol/document.do' and query['id'][0].isdigit():
+            i = int(query['id'][0])
+            self.send(portal.statement_pdf(i), 'application/pdf', {'Content-Disposition': 'attachment; filename=statement_{}.pdf'.format(2017 - i)})
+        else:
+            self.send('<html><body>Not found</body></html>', status=404)
+
+
+def start(portal, port=0):
+    '''
+    serve the portal in a background thread, returns the server and the login url
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', port), PortalHandler)
+    server.daemon_threads = True
+    server.portal = portal
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}/login.jsp'.format(server.server_address[1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a local stand-in DCPS portal.')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on (default 8080)')
+    parser.add_argument('--detail-pages', type=int, default=12, help='number of contribution detail pages (default 12)')
+    parser.add_argument('--statements', type=int, default=1, help='number of Individual Statement PDFs (default 1)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request (default 0)')
+    args = parser.parse_args()
+
+    portal = Portal(args.detail_pages, args.statements, args.latency)
+    server, url = start(portal, args.port)
+    print("Stand-in DCPS portal on {} - id {} password {}".format(url, portal.dcps_id, portal.dcps_pwd))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
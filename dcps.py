@@ -5,47 +5,187 @@ NATO DCPS monitoring tool - Defined Contribution Pension Scheme
 @copyright: AGPLv3
 '''
 
-import argparse
+import hashlib
+import json
+import mmap
+import os
 import sqlite3
-import requests
-from bs4 import BeautifulSoup
 import re
 import time
-from datetime import datetime
-from tabulate import tabulate
-try:
-    import keys
-except Exception:
-    exit("ERROR: keys.py file with dcps_url, dcps_id, dcps_pwd does not exist.")
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+import dcps_metrics
+# the heavier modules (requests, lxml, tabulate, numpy, slate, ...) are imported in the functions that need them,
+# so importing this module, or a run that does not use them, does not pay for them
+
+
+class DCPSError(Exception):
+    '''
+    base class of the errors raised by this tool
+    '''
+
+
+class AuthenticationError(DCPSError):
+    '''
+    the portal refused the credentials
+    '''
+
+
+class PasswordChangeError(AuthenticationError):
+    '''
+    the portal requests a change of the temporary first-access password
+    '''
+
+
+class PortalError(DCPSError):
+    '''
+    the portal could not be reached or answered with an error, after the retries
+    '''
 
 
 class DCPS:
-    def __init__(self, dcps_url, dcps_id, dcps_pwd, args=None):
+    def __init__(self, dcps_url, dcps_id, dcps_pwd, args=None, workers=4, db_file='dcps.sqlite3.db', db_wal=False, processes=None, docs_dir='.',
+                 timeout=60, retries=3, metrics=None, quiet=False, state_dir=None):
         self.dcps_url = dcps_url
         self.dcps_id = dcps_id
         self.dcps_pwd = dcps_pwd
+        self.account = '' if dcps_id is None else str(dcps_id)  # value of the account column in the database
+        self.workers = workers     # number of parallel web requests, 1 = sequential
+        self.processes = processes  # number of PDFs parsed in parallel, None = number of CPUs
+        self.docs_dir = docs_dir   # where the downloaded documents are saved
+        self.db_file = db_file     # None = no database, for instances that only scrape
+        self.db_wal = db_wal       # WAL journal, so readers do not block the writer
         self.web_sess = None       # web session
+        self.web_session = None    # saved cookies and home page url of the web session, reused by the next runs
+        self.state_dir = state_dir or DCPS.default_state_dir()   # where the web sessions are saved, readable by the user only
+        self.timeout = timeout     # seconds to wait for the portal to connect or send data
+        self.retries = retries     # number of retries of failed connections and server errors
+        self.metrics = metrics or dcps_metrics.METRICS   # time, requests, bytes and rows per phase
+        self.quiet = quiet         # print nothing but errors, the tables are not even rendered
         self.sql_conn = None    # SQLite connection
         self.webpage_main = None  # response of main webpage
         self.webpage_doc = None   # response of documents webpage
+        self.run_id = None        # changelog id of the database writes done by this instance
+        self.page_cache = None    # contribution detail pages of the previous runs, by url path
+        self.valuations = {}      # dcps_valuation.Valuation of the accounts loaded by db_get_valuation(), by account
+        self.valuation_rows = []  # rows written but not committed yet, applied to the valuations by db_commit()
+
+        if self.db_file:
+            self.sqlite3_createdb()
+
+    SCHEMA_VERSION = 4
+    # version of the PDF statement parsing, the cached results of older versions are parsed again.
+    # Increase it when pdf_parse() or dcps_statement change their results.
+    PDF_PARSER_VERSION = 1
+    SCHEMA = {
+        'contributions': 'CREATE TABLE contributions (date text, date_unix integer, currency text, opcode text, amount real, account text, UNIQUE(account, date, currency, opcode, amount))',
+        'balance_now': 'CREATE TABLE balance_now (date text, date_unix integer, currency text, fund text, amount real, total_units real, price_per_unit real, account text, UNIQUE(account, date, currency, fund, amount))',
+        'balance_year': 'CREATE TABLE balance_year (date text, date_unix integer, currency text, fund text, amount real, total_units real, price_per_unit real, account text, UNIQUE(account, date, currency, fund, amount))',
+        'contributions_detail': 'CREATE TABLE contributions_detail(date_operation text, date_operation_unix integer, date_nav text, date_nav_unix integer, fund text, exchange_rate real, amount_gross real, fees real, amount_net real, units real, price_per_unit real, account text, UNIQUE(account, date_operation, fund, units))',
+        'changelog': 'CREATE TABLE changelog (run_id integer, run_unix integer, account text, table_name text, action text, data text)',
+        'page_cache': 'CREATE TABLE page_cache (account text, path text, sha256 text, etag text, last_modified text, data text, fetched_unix integer, UNIQUE(account, path))',
+        'pdf_cache': 'CREATE TABLE pdf_cache (sha256 text, parser_version integer, data text, parsed_unix integer, UNIQUE(sha256))',
+        'documents': 'CREATE TABLE documents (account text, path text, filename text, disposition_name text, size integer, sha256 text, downloaded_unix integer, UNIQUE(account, path))'
+    }
+    # tables of older versions that are dropped: the sessions hold authentication cookies, they are now saved in the state directory
+    OBSOLETE = ['sessions']
+    # tables db_export() can write, the other ones are internal caches
+    EXPORT_TABLES = ['contributions', 'balance_now', 'balance_year', 'contributions_detail', 'changelog']
+    # (account, fund, date) serves the per fund queries and the list of funds, (account, date) the date ranges
+    INDEXES = [
+        'CREATE INDEX IF NOT EXISTS contributions_date ON contributions (account, date_unix)',
+        'CREATE INDEX IF NOT EXISTS balance_now_fund_date ON balance_now (account, fund, date_unix)',
+        'CREATE INDEX IF NOT EXISTS balance_now_date ON balance_now (account, date_unix)',
+        'CREATE INDEX IF NOT EXISTS balance_year_fund_date ON balance_year (account, fund, date_unix)',
+        'CREATE INDEX IF NOT EXISTS balance_year_date ON balance_year (account, date_unix)',
+        'CREATE INDEX IF NOT EXISTS contributions_detail_fund_date ON contributions_detail (account, fund, date_operation_unix)',
+        'CREATE INDEX IF NOT EXISTS contributions_detail_date ON contributions_detail (account, date_operation_unix)',
+        'CREATE INDEX IF NOT EXISTS changelog_run ON changelog (run_id)'
+    ]
+    # columns of the data tables in insert order, the unique key (account and text date first, see db_upsert()) and the date_unix column of the date filters
+    COLUMNS = {
+        'contributions': ['date', 'date_unix', 'currency', 'opcode', 'amount', 'account'],
+        'balance_now': ['date', 'date_unix', 'currency', 'fund', 'amount', 'total_units', 'price_per_unit', 'account'],
+        'balance_year': ['date', 'date_unix', 'currency', 'fund', 'amount', 'total_units', 'price_per_unit', 'account'],
+        'contributions_detail': ['date_operation', 'date_operation_unix', 'date_nav', 'date_nav_unix', 'fund', 'exchange_rate', 'amount_gross', 'fees', 'amount_net', 'units', 'price_per_unit', 'account']
+    }
+    KEYS = {
+        'contributions': ['account', 'date', 'currency', 'opcode', 'amount'],
+        'balance_now': ['account', 'date', 'currency', 'fund', 'amount'],
+        'balance_year': ['account', 'date', 'currency', 'fund', 'amount'],
+        'contributions_detail': ['account', 'date_operation', 'fund', 'units']
+    }
+    DATE_COLUMN = {
+        'contributions': 'date_unix',
+        'balance_now': 'date_unix',
+        'balance_year': 'date_unix',
+        'contributions_detail': 'date_operation_unix'
+    }
+
+    def html_parse(content, encoding=None):
+        '''
+        parse a page into an lxml tree, the tables are then located with XPath.
+        This is much faster and lighter than building a BeautifulSoup tree and searching it with regexes.
+        content is the bytes of the response, lxml refuses a str when the page starts with an XML encoding declaration.
+        encoding is the one of the response (r.encoding), None lets libxml2 detect it.
+        '''
+        import lxml.html
+        return lxml.html.document_fromstring(content, parser=lxml.html.HTMLParser(encoding=encoding) if encoding else None)
 
-        self.sqlite3_createdb()
+    def html_form_action(doc, value):
+        '''
+        action of the form containing the input with the given value, e.g. MAIN-APP-I-I-IOM
+        '''
+        return doc.xpath('//input[@value=$value]/..', value=value)[0].get('action')
 
     def html_table_to_dict_array(table):
-        headers = [header.get_text().strip() for header in table.find_all("th")]
+        headers = [header.text_content().strip() for header in table.iter('th')]
         results = []
-        for row in table.find_all('tr'):
-            if row.td and row.td.get('colspan'):
+        for row in table.iter('tr'):
+            td = row.find('.//td')
+            if td is not None and td.get('colspan'):
                 continue
-            if row.th:
+            if row.find('.//th') is not None:
                 continue
             results_row = {}
-            for i, col in enumerate(row.find_all('td')):
-                results_row[headers[i]] = col.get_text().strip()
+            for i, col in enumerate(row.iter('td')):
+                results_row[headers[i]] = col.text_content().strip()
             if len(results_row) > 0:
                 results.append(results_row)
         return results
 
+    def html_parse_balance_page(content, encoding=None):
+        '''
+        extract the tables of the MY CONTRIBUTION BALANCE page.
+        Returns the rows of each table and the links to the contribution detail pages.
+        '''
+        doc = DCPS.html_parse(content, encoding)
+        # the innermost cell with the title, its row is part of the table we need
+        balance_at_tables = [td.getparent().getparent() for td in doc.xpath('//td[not(.//td)][contains(., "Balance at")]')[:2]]
+        year_details_table = doc.xpath('//td[not(.//td)][contains(., "Current Year Details")]')[0].getparent().getparent()
+        results = {
+            'balance_year': DCPS.normalise_data(DCPS.html_table_to_dict_array(balance_at_tables[0])),
+            'contributions': DCPS.normalise_data(DCPS.html_table_to_dict_array(year_details_table)),
+            'balance_now': DCPS.normalise_data(DCPS.html_table_to_dict_array(balance_at_tables[1]))
+        }
+        return results, [a.get('href') for a in year_details_table.iter('a')]
+
+    def html_parse_detail_page(content, encoding=None):
+        '''
+        extract the rows of a contribution detail page
+        '''
+        doc = DCPS.html_parse(content, encoding)
+        table = doc.xpath('//th[not(.//th)][contains(., "Operation Date")]/ancestor::table[1]')[0]
+        return DCPS.normalise_data(DCPS.html_table_to_dict_array(table))
+
+    def html_parse_documents_page(content, encoding=None):
+        '''
+        extract the links to the Individual Statement documents
+        '''
+        doc = DCPS.html_parse(content, encoding)
+        return doc.xpath('//a[contains(., "Individual Statement")]/@href')
+
     def sqlite3_createdb(self):
         '''
         Singleton to get access to the database connection
@@ -53,20 +193,63 @@ class DCPS:
         if self.sql_conn:
             return self.sql_conn
 
-        self.sql_conn = sqlite3.connect('dcps.sqlite3.db')
+        self.sql_conn = sqlite3.connect(self.db_file)
         c = self.sql_conn.cursor()
-        queries = ['CREATE TABLE contributions (date text, date_unix integer, currency text, opcode text, amount real, UNIQUE(date, currency, opcode, amount) ON CONFLICT REPLACE)',
-                   'CREATE TABLE balance_now (date text, date_unix integer, currency text, fund text, amount real, total_units real, price_per_unit real, UNIQUE(date, currency, fund, amount) ON CONFLICT REPLACE)',
-                   'CREATE TABLE balance_year (date text, date_unix integer, currency text, fund text, amount real, total_units real, price_per_unit real, UNIQUE(date, currency, fund, amount) ON CONFLICT REPLACE)',
-                   'CREATE TABLE contributions_detail(date_operation text, date_operation_unix integer, date_nav text, date_nav_unix integer, fund text, exchange_rate real, amount_gross real, fees real, amount_net real, units real, price_per_unit real, UNIQUE(date_operation, fund, units) ON CONFLICT REPLACE)']
-        for query in queries:
+        if self.db_wal:
+            # WAL mode is stored in the database file, readers keep working on the last commit while we write.
+            # With WAL a commit only needs to be synced at checkpoints, so synchronous=NORMAL is still safe against corruption.
+            c.execute("PRAGMA journal_mode = WAL")
+            c.execute("PRAGMA synchronous = NORMAL")
+            c.execute("PRAGMA temp_store = MEMORY")
+        self.sqlite3_migratedb(c)
+        for query in DCPS.SCHEMA.values():
             try:
                 c.execute(query)
             except sqlite3.OperationalError as e:
                 pass
+        for query in DCPS.INDEXES:
+            c.execute(query)
+        c.execute("PRAGMA user_version = {}".format(DCPS.SCHEMA_VERSION))
         self.sql_conn.commit()
         return self.sql_conn
 
+    def sqlite3_migratedb(self, c):
+        '''
+        upgrade the tables of a database created by an older version of this tool.
+        SQLite cannot change columns or UNIQUE constraints, so outdated tables are rebuilt and the data copied over.
+        '''
+        c.execute("PRAGMA user_version")
+        version = c.fetchone()[0]
+        if version >= DCPS.SCHEMA_VERSION:
+            return
+        c.execute("SELECT name, sql FROM sqlite_master WHERE type='table'")
+        tables = dict(c.fetchall())
+        # sqlite3 runs ALTER and CREATE TABLE outside of a transaction, a crash half way would leave the data in the _old table
+        c.execute("BEGIN")
+        with self.sql_conn:     # commits at the end, or rolls back everything on error
+            for table in DCPS.SCHEMA:
+                if table not in tables or tables[table] == DCPS.SCHEMA[table]:
+                    continue
+                c.execute("PRAGMA table_info({})".format(table))
+                columns = [x[1] for x in c.fetchall()]
+                c.execute("ALTER TABLE {0} RENAME TO {0}_old".format(table))
+                c.execute(DCPS.SCHEMA[table])
+                c.execute("PRAGMA table_info({})".format(table))
+                new_columns = [x[1] for x in c.fetchall()]
+                # the columns of both versions are copied, the added ones are left NULL
+                copied = ', '.join(x for x in columns if x in new_columns)
+                if 'account' in columns or 'account' not in new_columns:
+                    c.execute("INSERT INTO {0} ({1}) SELECT {1} FROM {0}_old".format(table, copied))
+                elif self.account:
+                    # version 1 added the account column, existing rows belong to the account opening the database
+                    c.execute("INSERT INTO {0} ({1}, account) SELECT {1}, ? FROM {0}_old".format(table, copied), [self.account])
+                else:
+                    # the rows would be stamped with an empty account, for good
+                    raise DCPSError("The database {} was created by an older version, update it once with the account it belongs to (keys.py) to upgrade it.".format(self.db_file))
+                c.execute("DROP TABLE {0}_old".format(table))
+            for table in DCPS.OBSOLETE:
+                c.execute("DROP TABLE IF EXISTS {}".format(table))
+
     def normalise_data(data):
         for row in data:
             # transform the string numbers into float numbers
@@ -79,179 +262,632 @@ class DCPS:
     def date_to_unix(s):
         return time.mktime(datetime.strptime(s, "%d/%m/%Y").timetuple())
 
-    def db_insert_contributions(self, data):
-        c = self.sql_conn.cursor()
-        for i in data:
-            c.execute("INSERT INTO contributions VALUES(?,?,?,?,?)", [
-                i['Reference Date'],
-                DCPS.date_to_unix(i['Reference Date']),
-                i['Currency'],
-                i['Operation Code'],
-                i['Total Amount']])
-        self.sql_conn.commit()
+    @dcps_metrics.timed('db_insert_contributions')
+    def db_insert_contributions(self, data, account=None, commit=True):
+        account = self.account if account is None else account
+        return self.db_upsert('contributions', [[
+            i['Reference Date'],
+            DCPS.date_to_unix(i['Reference Date']),
+            i['Currency'],
+            i['Operation Code'],
+            i['Total Amount'],
+            account] for i in data], commit)
 
-    def db_insert_contributions_detail(self, data):
-        c = self.sql_conn.cursor()
-        for i in data:
-            if len(i) == 0:
-                continue
-            c.execute("INSERT INTO contributions_detail VALUES(?,?,?,?,?,?,?,?,?,?,?)", [
-                i['Operation Date'],
-                DCPS.date_to_unix(i['Operation Date']),
-                i['Nav Date'],
-                DCPS.date_to_unix(i['Nav Date']),
-                i['Fund'],
-                i['Exchange Rate'],
-                i['Gross Amount Inv/Dis'],
-                i['Fees (*)'],
-                i['Net Amount Inv/Dis'],
-                i['No. of Units'],
-                i['Price per Unit']])
-        self.sql_conn.commit()
+    @dcps_metrics.timed('db_insert_contributions_detail')
+    def db_insert_contributions_detail(self, data, account=None, commit=True):
+        account = self.account if account is None else account
+        return self.db_upsert('contributions_detail', [[
+            i['Operation Date'],
+            DCPS.date_to_unix(i['Operation Date']),
+            i['Nav Date'],
+            DCPS.date_to_unix(i['Nav Date']),
+            i['Fund'],
+            i['Exchange Rate'],
+            i['Gross Amount Inv/Dis'],
+            i['Fees (*)'],
+            i['Net Amount Inv/Dis'],
+            i['No. of Units'],
+            i['Price per Unit'],
+            account] for i in data if len(i) > 0], commit)
+
+    @dcps_metrics.timed('db_insert_balance_now')
+    def db_insert_balance_now(self, data, account=None, commit=True):
+        account = self.account if account is None else account
+        return self.db_upsert('balance_now', [[
+            i['NAV date'],
+            DCPS.date_to_unix(i['NAV date']),
+            i['Currency'],
+            i['Fund'],
+            i['Amount'],
+            i['Total Units'],
+            i['Price per UNIT'],
+            account] for i in data], commit)
 
-    def db_insert_balance_now(self, data):
+    @dcps_metrics.timed('db_insert_balance_year')
+    def db_insert_balance_year(self, data, account=None, commit=True):
+        account = self.account if account is None else account
+        return self.db_upsert('balance_year', [[
+            i['NAV date'],
+            DCPS.date_to_unix(i['NAV date']),
+            i['Currency'],
+            i['Fund'],
+            i['Amount'],
+            i['Total Units'],
+            i['Price per UNIT'],
+            account] for i in data], commit)
+
+    def db_upsert(self, table, rows, commit=True):
+        '''
+        insert the new rows and update the changed rows of a table, rows identical to the stored ones are not written.
+        Every write is recorded in the changelog table, so consumers can process the deltas of a run instead of whole tables.
+        Returns the list of changes.
+        '''
+        columns = DCPS.COLUMNS[table]
+        key = [columns.index(k) for k in DCPS.KEYS[table]]
+        value = [i for i in range(len(columns)) if i not in key]
+        incoming = {}
+        for row in rows:
+            incoming[tuple(row[i] for i in key)] = tuple(row)   # the last row wins, like ON CONFLICT REPLACE did
+        if not incoming:
+            return []
+
+        # only load the stored rows with the account and date of the incoming rows, a prefix of the UNIQUE index.
+        # The text date of the key, date_unix depends on the timezone of the run that wrote it.
         c = self.sql_conn.cursor()
-        for i in data:
-            c.execute("INSERT INTO balance_now VALUES(?,?,?,?,?,?,?)", [
-                i['NAV date'],
-                DCPS.date_to_unix(i['NAV date']),
-                i['Currency'],
-                i['Fund'],
-                i['Amount'],
-                i['Total Units'],
-                i['Price per UNIT']])
+        account, date = key[0], key[1]
+        stored = {}
+        for acc in set(row[account] for row in incoming.values()):
+            dates = sorted(set(row[date] for row in incoming.values() if row[account] == acc))
+            for n in range(0, len(dates), 500):     # SQLite limits the number of parameters of a query
+                c.execute("SELECT {} FROM {} WHERE account = ? AND {} IN ({})".format(', '.join(columns), table, columns[date], ','.join('?' * len(dates[n:n + 500]))),
+                          [acc] + dates[n:n + 500])
+                stored.update((tuple(row[i] for i in key), row) for row in c.fetchall())
+
+        inserts = [row for k, row in incoming.items() if k not in stored]
+        updates = [row for k, row in incoming.items() if k in stored and stored[k] != row]
+        # a row written meanwhile by another writer is updated instead of failing the whole transaction
+        c.executemany("INSERT INTO {} VALUES({}) ON CONFLICT({}) DO UPDATE SET {}".format(table, ','.join('?' * len(columns)),
+                                                                                         ', '.join(DCPS.KEYS[table]),
+                                                                                         ', '.join('{0} = excluded.{0}'.format(columns[i]) for i in value)),
+                      inserts + updates)
+
+        for acc in self.valuations:
+            # keep the loaded valuations up to date instead of reloading them, once the rows are committed
+            self.valuation_rows.append((acc, table, [dict(zip(columns, row)) for row in inserts + updates if row[account] == acc],
+                                        [dict(zip(columns, stored[k])) for k, row in incoming.items() if row[account] == acc and k in stored and stored[k] != row]))
+
+        run_id = self.db_get_run_id()
+        run_unix = int(time.time())
+        changes = [[run_id, run_unix, row[account], table, 'insert', json.dumps(dict(zip(columns, row)))] for row in inserts]
+        changes += [[run_id, run_unix, row[account], table, 'update', json.dumps(dict(zip(columns, row)))] for row in updates]
+        c.executemany("INSERT INTO changelog VALUES(?,?,?,?,?,?)", changes)
+        self.metrics.count(rows=len(changes))
+        if commit:
+            self.db_commit()
+        return changes
+
+    def db_commit(self):
+        '''
+        commit, then apply the committed rows to the loaded valuations
+        '''
         self.sql_conn.commit()
+        for account, table, rows, old_rows in self.valuation_rows:
+            if account in self.valuations:
+                self.valuations[account].apply_rows(table, rows, old_rows)
+        self.valuation_rows = []
+
+    @contextmanager
+    def db_transaction(self):
+        '''
+        commits at the end, or rolls back everything on error, the loaded valuations then keep matching the database
+        '''
+        try:
+            with self.sql_conn:
+                yield
+        except BaseException:
+            self.valuation_rows = []
+            raise
+        self.db_commit()    # already committed, applies the rows
+
+    def db_get_run_id(self):
+        '''
+        the id under which the writes of this instance are recorded in the changelog
+        '''
+        if self.run_id is None:
+            c = self.sql_conn.cursor()
+            c.execute("SELECT COALESCE(MAX(run_id), 0) + 1 FROM changelog")
+            self.run_id = c.fetchone()[0]
+        return self.run_id
 
-    def db_insert_balance_year(self, data):
+    def db_get_changes(self, run_id=None):
+        '''
+        returns the rows inserted or updated in a run, by default the last run
+        '''
         c = self.sql_conn.cursor()
-        for i in data:
-            c.execute("INSERT INTO balance_year VALUES(?,?,?,?,?,?,?)", [
-                i['NAV date'],
-                DCPS.date_to_unix(i['NAV date']),
-                i['Currency'],
-                i['Fund'],
-                i['Amount'],
-                i['Total Units'],
-                i['Price per UNIT']])
-        self.sql_conn.commit()
+        if run_id is None:
+            c.execute("SELECT MAX(run_id) FROM changelog")
+            run_id = c.fetchone()[0]
+        c.execute("SELECT run_id, run_unix, account, table_name, action, data FROM changelog WHERE run_id = ? ORDER BY rowid", [run_id])
+        return [{'run_id': x[0], 'run_unix': x[1], 'account': x[2], 'table': x[3], 'action': x[4], 'data': json.loads(x[5])}
+                for x in c.fetchall()]
+
+    def web_new_session(self):
+        '''
+        a requests session with a keep-alive connection pool and retries with exponential backoff
+        '''
+        import requests
+        import urllib3
+        sess = requests.Session()
+        # POST is not retried after the request was sent, only when the connection could not be made
+        retry = urllib3.util.Retry(total=self.retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+        # allow one pooled connection per worker, otherwise parallel requests would open and drop extra connections
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(self.workers, 1), max_retries=retry)
+        sess.mount('https://', adapter)
+        sess.mount('http://', adapter)
+        return sess
+
+    def web_request(self, method, url, **kwargs):
+        '''
+        send a request in the web session with the timeout, raises PortalError when it fails
+        '''
+        import requests
+        self.metrics.count(requests=1)
+        try:
+            r = self.web_sess.request(method, url, timeout=self.timeout, **kwargs)
+            r.raise_for_status()
+        except requests.RequestException as e:
+            raise PortalError("{} {} failed: {}".format(method, url, e)) from e
+        if not kwargs.get('stream'):    # streamed content is counted as it is read
+            self.metrics.count(bytes=len(r.content))
+        return r
 
+    @dcps_metrics.timed('login')
     def web_login(self, force=False):
+        '''
+        authenticate on the portal, reusing the session of a previous run when it is still valid.
+        Raises AuthenticationError or PortalError.
+        '''
         if self.webpage_main and not force:   # we are already authenticated, no new login needed
             return self.webpage_main
-        # build a permanent session object, this way we keep all cookies and such
-        self.web_sess = requests.Session()
+        # build a permanent session object, this way we keep all cookies and such.
+        # A long running instance keeps it, and its pooled connections, when it checks its login again.
+        if self.web_sess is None:
+            self.web_sess = self.web_new_session()
+        if self.web_session is None:
+            self.web_session = self.web_load_session()
+        if not force and self.web_session and self.web_resume_session(self.web_session):
+            return self.webpage_main
+        self.web_sess.cookies.clear()
 
         # first login on the main portal
         payload = {'id': self.dcps_id, 'pw': self.dcps_pwd, 'submit': 'SIGN ON'}
-        r = self.web_sess.post(self.dcps_url, data=payload)
+        r = self.web_request('POST', self.dcps_url, data=payload)
 
         # find the details of the form submit to login on the sub-site
-        soup = BeautifulSoup(r.text, 'lxml')
-        i = soup.find('input', attrs={"name": "token-authentication"})
+        i = DCPS.html_parse(r.content, r.encoding).xpath('//input[@name="token-authentication"]')
         if not i:
-            exit("ERROR: Authentication error, cannot login.")
-        payload = {'token-authentication': i.get('value'), 'ecol': 'Go To My Dcps'}
-        url = i.parent.get('action')  # load the URL from the form, this way we don't expose it here
-        r = self.web_sess.post(url, data=payload)
+            raise AuthenticationError("Authentication error, cannot login.")
+        payload = {'token-authentication': i[0].get('value'), 'ecol': 'Go To My Dcps'}
+        url = i[0].getparent().get('action')  # load the URL from the form, this way we don't expose it here
+        r = self.web_request('POST', url, data=payload)
         if "Your TEMPORARY first-access password" in r.text:
-            exit("ERROR: Change of password requested. Please login manually and change your password.")
+            raise PasswordChangeError("Change of password requested. Please login manually and change your password.")
         # now we are on the real site with the numbers
         self.webpage_main = r
+        self.web_save_session()
         return self.webpage_main
 
+    def web_resume_session(self, session):
+        '''
+        restore the cookies of a previous run and check with one request to the home page that they are still valid.
+        Returns False if a new login is needed.
+        '''
+        for cookie in session['cookies']:
+            self.web_sess.cookies.set(**cookie)
+        if not session.get('home_url'):
+            return False
+        try:
+            r = self.web_request('POST', session['home_url'], data={'f-token': 'MAIN-APP-I-I-HOM', 'c-token': 'MAIN-APP-I-I-HOM-HOM', 'a-token': 'null'})
+        except PortalError:
+            return False
+        if 'MAIN-APP-I-I-IOM' not in r.text:   # the login page, or an error page
+            return False
+        self.webpage_main = r
+        self.web_save_session()
+        return True
+
+    def web_save_session(self):
+        '''
+        keep the cookies of the authenticated session and the url of the home page, not the personal pages
+        '''
+        try:
+            action = DCPS.html_form_action(DCPS.html_parse(self.webpage_main.content, self.webpage_main.encoding), "MAIN-APP-I-I-HOM")
+            home_url = '/'.join(self.webpage_main.url.split('/')[:3]) + action
+        except IndexError:
+            home_url = None
+        self.web_session = {'home_url': home_url,
+                            'cookies': [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path, 'secure': c.secure, 'expires': c.expires}
+                                        for c in self.web_sess.cookies]}
+        self.web_store_session(self.web_session)
+
+    def default_state_dir():
+        '''
+        the state directory of the user, $XDG_STATE_HOME/dcps or ~/.local/state/dcps
+        '''
+        return os.path.join(os.environ.get('XDG_STATE_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'state'), 'dcps')
+
+    def web_session_file(self, account=None):
+        account = self.account if account is None else account
+        return os.path.join(self.state_dir, 'session-{}.json'.format(re.sub(r'[^\w.-]', '_', account)))
+
+    def web_load_session(self, account=None):
+        '''
+        returns the web session saved by a previous run of an account, or None
+        '''
+        try:
+            with open(self.web_session_file(account)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def web_store_session(self, session, account=None):
+        '''
+        save the web session of an account in its own file, readable by the user only:
+        the cookies give access to the account, they are kept out of the database other programs read
+        '''
+        os.makedirs(self.state_dir, mode=0o700, exist_ok=True)
+        fname = self.web_session_file(account)
+        # written to a temporary file first (created 0600), a concurrent run must never read a half written session
+        import tempfile
+        fd, tmp = tempfile.mkstemp(dir=self.state_dir, prefix='.session-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(session, f)
+        os.replace(tmp, fname)
+
+    @dcps_metrics.timed('update_from_webpage')
     def db_update_from_webpage(self):
+        results = self.web_scrape_webpage()
+        self.print_webpage(results)
+        self.db_insert_webpage(results)
+
+    @dcps_metrics.timed('scrape')
+    def web_scrape_webpage(self):
+        '''
+        login, download and parse the MY CONTRIBUTION BALANCE page and its contribution details.
+        Returns a dict with the rows of each database table, without touching the database.
+        '''
         self.web_login()
 
         # load the MY CONTRIBUTION BALANCE page containing all the juicy details
-        soup = BeautifulSoup(self.webpage_main.text, 'lxml')
-        tmp_input = soup.find('input', value="MAIN-APP-I-I-IOM")
-        url = '/'.join(self.webpage_main.url.split('/')[:3]) + tmp_input.parent.get('action')  # load the URL from within the page, this way we don't expose it here
+        action = DCPS.html_form_action(DCPS.html_parse(self.webpage_main.content, self.webpage_main.encoding), "MAIN-APP-I-I-IOM")
+        url = '/'.join(self.webpage_main.url.split('/')[:3]) + action  # load the URL from within the page, this way we don't expose it here
         payload = {'f-token': 'MAIN-APP-I-I-IOM',
                    'c-token': 'MAIN-APP-I-I-IOM-IOM',
                    'a-token': 'null'}
-        r = self.web_sess.post(url, payload)
-        soup = BeautifulSoup(r.text, 'lxml')
+        r = self.web_request('POST', url, data=payload)
+        # Balance Previous year, Current Year contributions - Summary, Current Balance
+        results, hrefs = DCPS.html_parse_balance_page(r.content, r.encoding)
+
+        # Current Year contributions - Detail
+        base_url = '/'.join(r.url.split('/')[:3])  # load the URL from within the page, this way we don't expose it here
+        urls = sorted(set(base_url + href for href in hrefs))
+        if self.page_cache is None and self.sql_conn:
+            self.page_cache = self.db_get_page_cache()
+        with self.metrics.phase('detail_pages'):
+            if self.workers > 1:
+                from concurrent.futures import ThreadPoolExecutor
+                # executor.map() keeps the order of the urls, so the result is identical to the sequential fetch
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    pages = list(executor.map(self.web_get_contributions_detail, urls))
+            else:
+                pages = [self.web_get_contributions_detail(url) for url in urls]
+        results['contributions_detail'] = [row for rows, entry in pages for row in rows]
+        # only the pages that changed since the previous run need to be written to the database
+        results['page_cache'] = {DCPS.url_path(url): entry for url, (rows, entry) in zip(urls, pages) if entry}
+        return results
 
-        # Balance Previous year
-        tmp_balance_at_tds = soup.find_all('td', limit=2, string=re.compile("Balance at"))
-        balance_year_table = tmp_balance_at_tds[0].parent.parent
-        results = DCPS.normalise_data(DCPS.html_table_to_dict_array(balance_year_table))
+    @dcps_metrics.timed('print')
+    def print_webpage(self, results):
+        if self.quiet:
+            return
+        from tabulate import tabulate
         print()
         print("BALANCE PREVIOUS YEAR")
-        print(tabulate(results, headers='keys'))
-        self.db_insert_balance_year(results)
-
-        # Current Year contributions - Summary
-        tmp_year_details_td = soup.find('td', string=re.compile("Current Year Details"))
-        year_details_table = tmp_year_details_td.parent.parent
-        results = DCPS.normalise_data(DCPS.html_table_to_dict_array(year_details_table))
+        print(tabulate(results['balance_year'], headers='keys'))
         print()
         print("CURRENT YEAR CONTRIBUTIONS - SUMMARY")
-        print(tabulate(results, headers='keys'))
-        self.db_insert_contributions(results)
-
-        # Current Year contributions - Detail
+        print(tabulate(results['contributions'], headers='keys'))
         print()
         print("CURRENT YEAR CONTRIBUTIONS - DETAILS")
-        ahrefs = year_details_table.find_all('a')
-        urls = set()
-        contributions_detail = []
-        for ahref in ahrefs:
-            urls.add(ahref.get('href'))
-        j = 0
-        for url in urls:
-            url = '/'.join(r.url.split('/')[:3]) + url  # load the URL from within the page, this way we don't expose it here
-            url_r = self.web_sess.get(url)
-            j += 1
-            url_soup = BeautifulSoup(url_r.text, 'lxml')
-            tmp_operation_date_td = url_soup.find('th', string=re.compile("Operation Date"))
-            url_details_table = tmp_operation_date_td.find_parent('table')
-            url_results = DCPS.normalise_data(DCPS.html_table_to_dict_array(url_details_table))
-            contributions_detail += url_results
-            self.db_insert_contributions_detail(url_results)
         print()
-        print(tabulate(contributions_detail, headers='keys'))
-
-        # Current Balance
-        balance_now_table = tmp_balance_at_tds[1].parent.parent
-        results = DCPS.normalise_data(DCPS.html_table_to_dict_array(balance_now_table))
+        print(tabulate(results['contributions_detail'], headers='keys'))
         print()
         print("CURRENT BALANCE")
-        print(tabulate(results, headers='keys'))
-        self.db_insert_balance_now(results)
+        print(tabulate(results['balance_now'], headers='keys'))
 
+    @dcps_metrics.timed('db_insert_webpage')
+    def db_insert_webpage(self, results, account=None):
+        '''
+        store the results of web_scrape_webpage() in the database, in one transaction.
+        Without a 'page_cache' key, e.g. results built by the caller, all the rows of results['contributions_detail'] are written.
+        '''
+        account = self.account if account is None else account
+        page_cache = results.get('page_cache')
+        if page_cache is None:
+            contributions_detail = results['contributions_detail']
+        else:
+            # the rows of the unchanged contribution detail pages are already in the database
+            contributions_detail = [row for entry in page_cache.values() for row in entry['rows']]
+        with self.db_transaction():
+            self.db_insert_balance_year(results['balance_year'], account, commit=False)
+            self.db_insert_contributions(results['contributions'], account, commit=False)
+            self.db_insert_contributions_detail(contributions_detail, account, commit=False)
+            self.db_insert_balance_now(results['balance_now'], account, commit=False)
+            if page_cache:
+                self.db_insert_page_cache(page_cache, account, commit=False)
+        if page_cache and self.page_cache is not None and account == self.account:
+            self.page_cache.update(page_cache)
+
+    def url_path(url):
+        '''
+        the path and query of a url, the key of the page cache
+        '''
+        u = urlsplit(url)
+        return u.path + ('?' + u.query if u.query else '')
+
+    def db_get_page_cache(self, account=None):
+        '''
+        returns the cached contribution detail pages of an account, by url path
+        '''
+        account = self.account if account is None else account
+        c = self.sql_conn.cursor()
+        c.execute("SELECT path, sha256, etag, last_modified, data FROM page_cache WHERE account = ?", [account])
+        return {x[0]: {'sha256': x[1], 'etag': x[2], 'last_modified': x[3], 'rows': json.loads(x[4])} for x in c.fetchall()}
+
+    def db_insert_page_cache(self, page_cache, account=None, commit=True):
+        account = self.account if account is None else account
+        c = self.sql_conn.cursor()
+        fetched_unix = int(time.time())
+        c.executemany("INSERT OR REPLACE INTO page_cache VALUES(?,?,?,?,?,?,?)", [[
+            account,
+            path,
+            entry['sha256'],
+            entry['etag'],
+            entry['last_modified'],
+            json.dumps(entry['rows']),
+            fetched_unix] for path, entry in page_cache.items()])
+        if commit:
+            self.sql_conn.commit()
+
+    def web_get_contributions_detail(self, url):
+        '''
+        download and parse one contribution detail page.
+        Pages of past months do not change, so the page is only parsed if its content changed since the previous run,
+        and not even downloaded if the portal answers the conditional request with 304 Not Modified.
+        Returns the rows, and the new page cache entry or None if the page did not change.
+        Does not touch the database, so it can safely run in parallel threads.
+        '''
+        cached = (self.page_cache or {}).get(DCPS.url_path(url))
+        headers = {}
+        if cached and cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+        url_r = self.web_request('GET', url, headers=headers)
+        if cached and url_r.status_code == 304:
+            return cached['rows'], None
+        sha256 = hashlib.sha256(url_r.content).hexdigest()
+        if cached and cached['sha256'] == sha256:
+            return cached['rows'], None
+        rows = DCPS.html_parse_detail_page(url_r.content, url_r.encoding)
+        return rows, {'sha256': sha256,
+                      'etag': url_r.headers.get('ETag'),
+                      'last_modified': url_r.headers.get('Last-Modified'),
+                      'rows': rows}
+
+    @dcps_metrics.timed('documents_list')
     def web_get_documents_list(self):
-        # FIXME split this function into a generic function to get documents
-        # and another function using these results for the individual statement files merged in the db_update_from_pdf
+        return self.db_update_from_pdfs(self.web_get_documents())   # update the db using the pdf files on disk
+
+    @dcps_metrics.timed('documents')
+    def web_get_documents(self):
+        '''
+        download the Individual Statement documents not downloaded yet.
+        Returns the (filename, SHA-256) of all the Individual Statement files.
+        '''
         self.web_login()
 
-        # load the MY CONTRIBUTION BALANCE page containing all the juicy details
-        soup = BeautifulSoup(self.webpage_main.text, 'lxml')
-        tmp_input = soup.find('input', value="MAIN-APP-I-I-IDV")
-        url = '/'.join(self.webpage_main.url.split('/')[:3]) + tmp_input.parent.get('action')  # load the URL from within the page, this way we don't expose it here
+        # load the DOCUMENTS page
+        action = DCPS.html_form_action(DCPS.html_parse(self.webpage_main.content, self.webpage_main.encoding), "MAIN-APP-I-I-IDV")
+        url = '/'.join(self.webpage_main.url.split('/')[:3]) + action  # load the URL from within the page, this way we don't expose it here
         payload = {'f-token': 'MAIN-APP-I-I-IDV',
                    'c-token': 'MAIN-APP-I-I-IOM-IOM',
                    'a-token': 'null'}
-        r = self.web_sess.post(url, payload)
-        soup = BeautifulSoup(r.text, 'lxml')
-        ahrefs = soup.find_all('a', string=re.compile("Individual Statement"))
-        urls = set()
-        for ahref in ahrefs:
-            urls.add(ahref.get('href'))
-        for url in urls:
+        r = self.web_request('POST', url, data=payload)
+        urls = set(DCPS.html_parse_documents_page(r.content, r.encoding))
+        documents = self.db_get_documents()
+        pdfs = []
+        for url in sorted(urls):
+            path = DCPS.url_path(url)
+            document = documents.get(path)
+            if document and os.path.isfile(document['filename']) and os.path.getsize(document['filename']) == document['size']:
+                pdfs.append((document['filename'], document['sha256']))   # downloaded in a previous run
+                continue
             url = '/'.join(self.webpage_main.url.split('/')[:3]) + url  # load the URL from within the page, this way we don't expose it here
-            url_r = self.web_sess.get(url)
+            document = self.web_download_document(url)
+            if not self.quiet:
+                print()
+                print("Saved Individual Statement file {}".format(document['filename']))
+            self.db_insert_document(path, document)
+            pdfs.append((document['filename'], document['sha256']))
+        return pdfs
+
+    def web_download_document(self, url):
+        '''
+        stream a document to a file in docs_dir, without holding it in memory.
+        Returns the document index entry.
+        '''
+        import requests
+        with self.web_request('GET', url, stream=True) as url_r:
             content_disposition = url_r.headers['content-disposition']
-            fname = re.findall("filename=(.+)", content_disposition)[0]
-            from io import BytesIO
-            f = BytesIO(url_r.content)
-            self.db_update_from_pdf(f)   # update the db using the in-memory pdf file
-            print()
-            print("Saving Individual Statement file {}".format(fname))   # TODO do this if the user requests to save the file locally
-            with open(fname, 'wb') as f:
-                f.write(url_r.content)
+            disposition_name = re.findall("filename=(.+)", content_disposition)[0].strip('"')
+            os.makedirs(self.docs_dir, exist_ok=True)
+            filename = os.path.join(self.docs_dir, os.path.basename(disposition_name))
+            sha256 = hashlib.sha256()
+            size = 0
+            # write to a temporary file first, an interrupted download must not look like a complete document
+            try:
+                with open(filename + '.part', 'wb') as f:
+                    for chunk in url_r.iter_content(chunk_size=64 * 1024):
+                        f.write(chunk)
+                        sha256.update(chunk)
+                        size += len(chunk)
+                        self.metrics.count(bytes=len(chunk))
+            except BaseException as e:
+                # nor leave the partial file behind
+                if os.path.exists(filename + '.part'):
+                    os.remove(filename + '.part')
+                if isinstance(e, requests.RequestException):
+                    raise PortalError("GET {} failed: {}".format(url, e)) from e
+                raise
+        os.replace(filename + '.part', filename)
+        return {'filename': filename,
+                'disposition_name': disposition_name,
+                'size': size,
+                'sha256': sha256.hexdigest()}
+
+    def db_get_documents(self):
+        '''
+        returns the index of the documents downloaded in previous runs, by url path
+        '''
+        c = self.sql_conn.cursor()
+        c.execute("SELECT path, filename, disposition_name, size, sha256 FROM documents WHERE account = ?", [self.account])
+        return {x[0]: {'filename': x[1], 'disposition_name': x[2], 'size': x[3], 'sha256': x[4]} for x in c.fetchall()}
+
+    def db_insert_document(self, path, document, commit=True):
+        c = self.sql_conn.cursor()
+        c.execute("INSERT OR REPLACE INTO documents VALUES(?,?,?,?,?,?,?)", [
+            self.account,
+            path,
+            document['filename'],
+            document['disposition_name'],
+            document['size'],
+            document['sha256'],
+            int(time.time())])
+        if commit:
+            self.sql_conn.commit()
+
+    def file_sha256(fname):
+        sha256 = hashlib.sha256()
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
 
     def db_update_from_pdf(self, f):
+        '''
+        update the database from one Individual Statement PDF file, given as a filename or a file object.
+        Returns the list of the files that failed, see db_update_from_pdfs().
+        '''
+        fname = f if isinstance(f, str) else getattr(f, 'name', None)
+        if isinstance(fname, str) and os.path.isfile(fname):
+            return self.db_update_from_pdfs([(fname, DCPS.file_sha256(fname))])
+        # the parser needs a file name, a file object without one (e.g. BytesIO) is spooled to a temporary file
+        import shutil
+        import tempfile
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as tmp:
+            shutil.copyfileobj(f, tmp)
+            tmp.flush()
+            return self.db_update_from_pdfs([(tmp.name, DCPS.file_sha256(tmp.name))])
+
+    def db_update_from_pdf_dir(self, path):
+        '''
+        offline backfill from a directory of already downloaded Individual Statement PDFs.
+        Returns the list of the files that failed, see db_update_from_pdfs().
+        '''
+        pdfs, failed = [], []
+        for fname in sorted(os.listdir(path)):
+            if not fname.lower().endswith('.pdf'):
+                continue
+            fname = os.path.join(path, fname)
+            try:
+                pdfs.append((fname, DCPS.file_sha256(fname)))
+            except OSError as e:
+                print("ERROR: {}: {}".format(fname, e))
+                failed.append(fname)
+        return failed + self.db_update_from_pdfs(pdfs)
+
+    @dcps_metrics.timed('update_from_pdfs')
+    def db_update_from_pdfs(self, pdfs):
+        '''
+        update the database from a list of (filename, SHA-256) Individual Statement PDFs.
+        Text extraction and parsing is CPU bound, so the PDFs are parsed in parallel processes.
+        The result is cached by SHA-256 of the PDF and PDF_PARSER_VERSION, a statement is only parsed once across runs, until the parser changes.
+        A PDF that cannot be parsed is reported, the others are still imported. Returns the list of the files that failed.
+        '''
+        cache = self.db_get_pdf_cache([sha256 for fname, sha256 in pdfs])
+        to_parse = {sha256: fname for fname, sha256 in pdfs if sha256 not in cache}
+        parsed, errors = {}, {}
+        with self.metrics.phase('pdf_parse'):
+            if len(to_parse) > 1 and self.processes != 1:
+                from concurrent.futures import ProcessPoolExecutor
+                with ProcessPoolExecutor(max_workers=self.processes) as executor:
+                    futures = {sha256: executor.submit(DCPS.pdf_parse, fname) for sha256, fname in to_parse.items()}
+                    for sha256, future in futures.items():
+                        try:
+                            parsed[sha256] = future.result()
+                        except Exception as e:     # a corrupt PDF, or one the parser does not understand
+                            errors[sha256] = e
+            else:
+                for sha256, fname in to_parse.items():
+                    try:
+                        parsed[sha256] = DCPS.pdf_parse(fname)
+                    except Exception as e:
+                        errors[sha256] = e
+
+        failed = []
+        for fname, sha256 in pdfs:
+            if sha256 in errors:
+                print("ERROR: {}: {}".format(fname, errors[sha256]))
+                failed.append(fname)
+                continue
+            contributions_detail = cache[sha256] if sha256 in cache else parsed[sha256]
+            contributions = DCPS.pdf_contributions_detail_dict_to_contributions_dict(contributions_detail)
+            with self.db_transaction():
+                self.db_insert_contributions_detail(contributions_detail, commit=False)
+                self.db_insert_contributions(contributions, commit=False)
+                if sha256 in parsed:
+                    self.db_insert_pdf_cache(sha256, contributions_detail, commit=False)
+                    parsed.pop(sha256)     # the same PDF might be given twice
+                    cache[sha256] = contributions_detail
+            # do something with the extracted data
+            if len(contributions_detail) and not self.quiet:
+                from tabulate import tabulate
+                print()
+                print("{} Holdings (DETAIL) page - contributions".format(fname))
+                print(tabulate(contributions_detail, headers='keys'))
+
+                print()
+                print("Computed contributions (summary)")
+                print(tabulate(contributions, headers='keys'))
+        return failed
+
+    def db_get_pdf_cache(self, sha256s):
+        '''
+        returns the cached contributions_detail rows of the PDFs parsed in previous runs by the current parser version, by SHA-256
+        '''
+        c = self.sql_conn.cursor()
+        c.execute("SELECT sha256, data FROM pdf_cache WHERE parser_version = ? AND sha256 IN ({})".format(','.join('?' * len(sha256s))),
+                  [DCPS.PDF_PARSER_VERSION] + sha256s)
+        return {x[0]: json.loads(x[1]) for x in c.fetchall()}
+
+    def db_insert_pdf_cache(self, sha256, contributions_detail, commit=True):
+        c = self.sql_conn.cursor()
+        c.execute("INSERT OR REPLACE INTO pdf_cache VALUES(?,?,?,?)", [sha256, DCPS.PDF_PARSER_VERSION, json.dumps(contributions_detail), int(time.time())])
+        if commit:
+            self.sql_conn.commit()
+
+    def pdf_parse(fname):
         '''
         FIXME WORK IN PROGRESS
         FIXME WORK IN PROGRESS
@@ -260,107 +896,230 @@ class DCPS:
 
         This is ugly code that will break when the PDF format changes.
         However it seems to do the trick.
-        It will extract the text from the pdf using the slate library,
-        and then transform the blob into nice tables,
-        and will finally store everything into the database
+        It will extract the text from the pdf file using the slate library,
+        and then dcps_statement transforms the blob into nice tables of contributions_detail rows.
+        Does not touch the database, so it can run in a process pool.
 
         You are free to email me your PDF files if they break and I will try to fix it.
         I will not keep any file you send me.
         '''
         import slate
+        import dcps_statement
         # TODO verify slate version
-        doc = slate.PDF(f)
-        contributions_detail = []
-
-        for page in doc:
-            if 'Holdings (SUMMARY)' in page:
-                print("Holdings (SUMMARY) page")
-            elif 'Holdings (DETAIL)' in page:
-                # remove header line and other pollution
-                page = re.sub(r'^.*Holdings \(DETAIL\)', '', page)
-                page = re.sub(r'TransactionInvestment', '', page)
-                page = re.sub(r'\x0c', '', page)
-                page = re.sub(r'TOTAL([0-9]{2}/[0-9]{2}/[0-9]{4})([A-Z]{3}[a-zA-Z ]+\([A-Z]{3}\))(-?[0-9.]+,[0-9]{3})', '', page)
-                # extract the columns with a big regex - note the last 2 columns are presented in a different way than they are visually seen on the page.
-                #   ([a-zA-Z \(\)\*]+)                  # operation code
-                #   ([0-9]{2}/[0-9]{2}/[0-9]{4})        # date
-                #   ([A-Z]{3}[a-zA-Z ]+\([A-Z]{3}\))    # fund (CURR)
-                #   (-?[0-9.]+,[0-9]{2})                # total amount
-                #   ([A-Z]{3})                          # currency
-                #   (-?[0-9.]+,[0-9]{2})                # amount invested
-                #   (-?[0-9.]+,[0-9]{3})                # total units
-                #   ([0-9.]+,[0-9]{4})                  # price per unit
-                page = re.sub(
-                    r'([a-zA-Z \(\)\*]+)([0-9]{2}/[0-9]{2}/[0-9]{4})([A-Z]{3}[a-zA-Z ]+\([A-Z]{3}\))(-?[0-9.]+,[0-9]{2})([A-Z]{3})(-?[0-9.]+,[0-9]{2})(-?[0-9.]+,[0-9]{3})([0-9.]+,[0-9]{4})',
-                    r'\1\t\2\t\3\t\4\t\5\t\6\t\8\t\7\n',
-                    page)
-                page = page.strip('\n')         # cleanup last newline our regex added
-                # we now have a clean table, iterate over each row in our newly made table and put everything in something usable
-                for line in page.split('\n'):
-                    # remove remaining polluting lines: summary, header
-                    if line.startswith('TOTAL') or line == 'Operation CodeFundInvestmentTotal AmountCurrencyTransactionAmount Invested /Disinvested / AccruedPrice per Unit(NAV)ReferenceDateTotal Units':
-                        continue
-                    line = line.replace('.', '').replace(',', '.')  # fix number format to match the website's format
-                    items = re.split('\t', line)
-                    contributions_detail.append(items)
-
-        contributions_detail = DCPS.normalise_data(DCPS.pdf_contributions_detail_list_to_dict_array(contributions_detail))
-        self.db_insert_contributions_detail(contributions_detail)
-        # do something with the extracted data
-        if len(contributions_detail):
-            print("Holdings (DETAIL) page - contributions")
-            print(tabulate(contributions_detail, headers='keys'))
-
-            print()
-            print("Computed contributions (summary)")
-            contributions = DCPS.pdf_contributions_detail_dict_to_contributions_dict(contributions_detail)
-            self.db_insert_contributions(contributions)
-            print(tabulate(contributions, headers='keys'))
+        with open(fname, 'rb') as f:
+            # the parser seeks around in the file, memory-map it instead of reading it all in memory
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    doc = slate.PDF(m)
+            else:
+                doc = slate.PDF(f)
+        return DCPS.pdf_contributions_detail_list_to_dict_array(dcps_statement.parse_pages(doc))
 
-    def db_get_funds(self):
+    def db_get_funds(self, account=None):
         '''
         returns a list of the funds
         '''
+        account = self.account if account is None else account
         c = self.sql_conn.cursor()
-        c.execute("SELECT DISTINCT fund FROM balance_now ORDER BY fund")
+        # loose index scan: jump from one fund to the next in the (account, fund, date_unix) index,
+        # instead of reading every daily balance like SELECT DISTINCT would
+        c.execute("""WITH RECURSIVE funds(fund) AS (
+                         SELECT MIN(fund) FROM balance_now WHERE account = :account
+                         UNION ALL
+                         SELECT (SELECT MIN(fund) FROM balance_now WHERE account = :account AND fund > funds.fund) FROM funds WHERE fund IS NOT NULL)
+                     SELECT fund FROM funds WHERE fund IS NOT NULL""", {'account': account})
         result = c.fetchall()
         return [x[0] for x in result]
 
-    def db_get_contributions_sum(self):
+    def db_get_balances(self, date=None, account=None):
+        '''
+        returns the balance of each fund at its latest NAV date, or its latest NAV date on or before date (dd/mm/YYYY).
+        The funds can have different latest NAV dates.
+        '''
+        account = self.account if account is None else account
+        date_unix = float('inf') if date is None else DCPS.date_to_unix(date)
         c = self.sql_conn.cursor()
-        c.execute("SELECT SUM(amount) FROM contributions")
-        result = c.fetchall()
-        return round(result[0][0], 2)
+        results = []
+        for fund in self.db_get_funds(account):
+            # one index lookup per fund
+            c.execute("SELECT date, currency, fund, amount, total_units, price_per_unit FROM balance_now "
+                      "WHERE account = ? AND fund = ? AND date_unix <= ? ORDER BY date_unix DESC LIMIT 1", [account, fund, date_unix])
+            row = c.fetchone()
+            if row:
+                results.append({'NAV date': row[0], 'Currency': row[1], 'Fund': row[2], 'Amount': row[3], 'Total Units': row[4], 'Price per UNIT': row[5]})
+        return results
 
-    def db_get_latest_balance(self):
+    def db_get_contributions_sum(self, start=None, end=None, account=None):
         '''
-        get the sum of the funds at the last balance
+        sum of the contributions, optionally between the start and end dates (dd/mm/YYYY, inclusive)
         '''
+        account = self.account if account is None else account
         c = self.sql_conn.cursor()
-        c.execute("SELECT amount FROM balance_now ORDER BY date_unix DESC LIMIT (SELECT COUNT (DISTINCT fund) FROM balance_now)")
+        c.execute("SELECT SUM(amount) FROM contributions WHERE account = ? AND date_unix BETWEEN ? AND ?",
+                  [account, DCPS.date_to_unix(start) if start else float('-inf'), DCPS.date_to_unix(end) if end else float('inf')])
         result = c.fetchall()
-        return sum([x[0] for x in result])
-        # return round(result[0][0], 2)
+        return round(result[0][0] or 0, 2)
+
+    def db_get_contributions_by_period(self, period='month', start=None, end=None, account=None):
+        '''
+        sum of the contributions per month or per year, optionally between the start and end dates (dd/mm/YYYY, inclusive)
+        '''
+        account = self.account if account is None else account
+        fmt = {'month': '%Y-%m', 'year': '%Y'}[period]
+        c = self.sql_conn.cursor()
+        # date_unix was computed in local time, see date_to_unix()
+        c.execute("SELECT strftime(?, date_unix, 'unixepoch', 'localtime') AS period, SUM(amount) FROM contributions "
+                  "WHERE account = ? AND date_unix BETWEEN ? AND ? GROUP BY period ORDER BY period",
+                  [fmt, account, DCPS.date_to_unix(start) if start else float('-inf'), DCPS.date_to_unix(end) if end else float('inf')])
+        return [{'Period': x[0], 'Total Amount': round(x[1], 2)} for x in c.fetchall()]
 
-    def pdf_contributions_detail_list_to_dict_array(table):
+    def db_get_latest_nav_date(self, account=None):
         '''
-        build a compatible list to insert the contributions as contributions_detail into the database
+        the most recent NAV date (dd/mm/YYYY) of the current balance in the database, None if there is none
+        '''
+        account = self.account if account is None else account
+        c = self.sql_conn.cursor()
+        c.execute("SELECT date FROM balance_now WHERE account = ? ORDER BY date_unix DESC LIMIT 1", [account])
+        row = c.fetchone()
+        return row[0] if row else None
+
+    def db_get_latest_balance(self, account=None):
+        '''
+        get the sum of the funds at their last balance
+        '''
+        return round(sum([x['Amount'] for x in self.db_get_balances(account=account)]), 2)
+
+    def db_get_valuation(self, account=None):
+        '''
+        returns the daily valuation of the holdings of an account: units, market value, invested capital and returns,
+        per fund and in total. See dcps_valuation.Valuation.
+        It is loaded once, later writes of this instance update it incrementally.
+        '''
+        account = self.account if account is None else account
+        if account not in self.valuations:
+            self.valuations[account] = self.db_load_valuation(account)
+        return self.valuations[account].refresh()
+
+    def db_load_valuation(self, account, fund=None):
+        '''
+        build the valuation of an account, or of one of its funds, from the database
+        '''
+        import dcps_valuation   # numpy is only needed for the valuation
+        where, params = "account = ?", [account]
+        if fund is not None:
+            where, params = where + " AND fund = ?", params + [fund]
+        c = self.sql_conn.cursor()
+        c.execute("SELECT date_operation_unix, date_nav_unix, fund, units, amount_gross, price_per_unit FROM contributions_detail WHERE " + where, params)
+        transactions = c.fetchall()
+        c.execute("SELECT date_unix, fund, price_per_unit FROM balance_year WHERE {0} "
+                  "UNION ALL SELECT date_unix, fund, price_per_unit FROM balance_now WHERE {0}".format(where), params + params)
+        return dcps_valuation.from_rows(transactions, c.fetchall())
+
+    def db_export(self, table, fname=None, fmt='csv', start=None, end=None, fund=None, accounts=None, chunk_size=10000):
+        '''
+        stream a table of EXPORT_TABLES, or the valuation history with table 'valuation', to a CSV, JSON Lines or Parquet file.
+        The rows are read and written in chunks of chunk_size rows, so the memory use does not grow with the table.
+        start and end (dd/mm/YYYY, inclusive), fund and accounts (list, default all accounts) filter the rows in SQL.
+        A filter the table has no column for raises ValueError, rather than exporting unfiltered rows.
+        fname None writes to stdout. Returns the number of rows written.
+        '''
+        import dcps_export
+        if table == 'valuation':
+            columns = dcps_export.VALUATION_COLUMNS
+            chunks = self.db_export_valuation(start, end, fund, accounts, chunk_size)
+        elif table in DCPS.EXPORT_TABLES:
+            c = self.sql_conn.cursor()
+            c.execute("PRAGMA table_info({})".format(table))
+            columns = [(x[1], x[2]) for x in c.fetchall()]
+            if fund is not None and 'fund' not in [name for name, sqltype in columns]:
+                raise ValueError("the table {} has no fund, it cannot be filtered by fund".format(table))
+            if (start or end) and table not in DCPS.DATE_COLUMN:
+                raise ValueError("the table {} has no date, it cannot be filtered by start or end date".format(table))
+            chunks = self.db_export_table(table, [name for name, sqltype in columns], start, end, fund, accounts, chunk_size)
+        else:
+            raise ValueError("unknown table {}".format(table))
+        return dcps_export.write(chunks, columns, fname, fmt)
+
+    def db_export_table(self, table, columns, start, end, fund, accounts, chunk_size):
+        '''
+        yields the filtered rows of a table in chunks, from a single query
+        '''
+        where, params = [], []
+        if accounts is not None and 'account' in columns:
+            where.append("account IN ({})".format(','.join('?' * len(accounts))))
+            params += [str(x) for x in accounts]
+        date_column = DCPS.DATE_COLUMN.get(table)
+        if date_column and start:
+            where.append("{} >= ?".format(date_column))
+            params.append(DCPS.date_to_unix(start))
+        if date_column and end:
+            where.append("{} <= ?".format(date_column))
+            params.append(DCPS.date_to_unix(end))
+        if fund is not None and 'fund' in columns:
+            where.append("fund = ?")
+            params.append(fund)
+        query = "SELECT {} FROM {}".format(', '.join(columns), table)
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        if date_column:
+            query += " ORDER BY account, {}".format(date_column)   # the order of the (account, date) index, no sorting needed
+        c = self.sql_conn.cursor()
+        c.execute(query, params)
+        while True:
+            rows = c.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+    def db_export_valuation(self, start, end, fund, accounts, chunk_size):
+        '''
+        yields the daily valuation rows of each fund and the total (fund None) in chunks, one account at a time
+        '''
+        import numpy as np
+        c = self.sql_conn.cursor()
+        if accounts is None:
+            c.execute("SELECT DISTINCT account FROM contributions_detail ORDER BY account")
+            accounts = [x[0] for x in c.fetchall()]
+        for account in accounts:
+            # the whole history is needed to compute the units and returns, the dates only filter the output
+            valuation = self.db_load_valuation(str(account), fund)
+            if not valuation.ndays:
+                continue
+            dates = valuation.dates()
+            s = 0 if start is None else int(np.searchsorted(dates, np.datetime64(datetime.strptime(start, "%d/%m/%Y").date())))
+            e = len(dates) if end is None else int(np.searchsorted(dates, np.datetime64(datetime.strptime(end, "%d/%m/%Y").date()), side='right'))
+            series = [(f, valuation.series(f)) for f in valuation.funds] + [(None, valuation.series())]
+            days_per_chunk = max(1, chunk_size // len(series))
+            for i in range(s, e, days_per_chunk):
+                j = min(i + days_per_chunk, e)
+                dmy = ['{}/{}/{}'.format(d[8:10], d[5:7], d[:4]) for d in np.datetime_as_string(dates[i:j])]
+                date_unix = [int(DCPS.date_to_unix(d)) for d in dmy]
+                chunk = [[f] + [x[k][i:j].tolist() if k in x else [None] * (j - i) for k in ['units', 'price', 'value', 'invested', 'twr']]
+                         for f, x in series]
+                rows = [(str(account), dmy[k], date_unix[k], f, units[k], price[k], value[k], invested[k], twr[k])
+                        for k in range(j - i) for f, units, price, value, invested, twr in chunk]
+                yield rows
+
+    def pdf_contributions_detail_list_to_dict_array(holdings):
+        '''
+        build a compatible list to insert the dcps_statement.Holding records as contributions_detail into the database
         '''
         results = []
-        for row in table:
+        for row in holdings:
+            date = '{:02d}/{:02d}/{:04d}'.format(row.date.day, row.date.month, row.date.year)
             results.append({
-                'Operation Code': row[0],
-                'Operation Date': row[1],
-                'Nav Date': row[1],        # this is not really correct, but it's the best we can do now, and it should not affect the rest as the unique constraint is not on the nav_date
-                'Fund': row[2],
-                'Total Amount': row[3],
-                'Currency': row[4],
-                'Gross Amount Inv/Dis': row[5],
-                'Net Amount Inv/Dis': row[5],
-                'Price per Unit': row[6],
-                'No. of Units': row[7],
-                'Exchange Rate': '1.0',
-                'Fees (*)': '0.0'
+                'Operation Code': row.operation_code,
+                'Operation Date': date,
+                'Nav Date': date,        # this is not really correct, but it's the best we can do now, and it should not affect the rest as the unique constraint is not on the nav_date
+                'Fund': row.fund,
+                'Total Amount': row.total_amount,
+                'Currency': row.currency,
+                'Gross Amount Inv/Dis': row.amount,
+                'Net Amount Inv/Dis': row.amount,
+                'Price per Unit': row.price_per_unit,
+                'No. of Units': row.units,
+                'Exchange Rate': 1.0,
+                'Fees (*)': 0.0
             })
         return results
 
@@ -399,28 +1158,268 @@ class DCPS:
         return results
 
 
+def load_accounts(fname):
+    '''
+    load the accounts of a batch run from a JSON file:
+    [{"dcps_url": "...", "dcps_id": "01234567", "dcps_pwd": "..."}, ...]
+    The dcps_id is a string, a number would lose its leading zeros.
+    '''
+    with open(fname) as f:
+        return json.load(f)
+
+
+def batch_scrape(account, workers=4, page_cache=None, timeout=60, retries=3):
+    '''
+    process pool worker: scrape the webpage of one account, the database is left to the writer in the main process
+    '''
+    dcps = DCPS(account['dcps_url'], account['dcps_id'], account['dcps_pwd'], workers=workers, db_file=None, timeout=timeout, retries=retries,
+                metrics=dcps_metrics.Metrics())
+    dcps.page_cache = page_cache
+    return dcps.account, dcps.web_scrape_webpage(), dcps.metrics.report()
+
+
+def batch_update(accounts, db_file='dcps.sqlite3.db', processes=None, workers=4, db_wal=False, timeout=60, retries=3, quiet=False):
+    '''
+    scrape all accounts in parallel processes.
+    Only this process writes to the database, so the scrapers never wait on each other for the database lock.
+    Returns the list of accounts that failed.
+    '''
+    writer = DCPS(None, None, None, db_file=db_file, db_wal=db_wal)
+    failed = []
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {executor.submit(batch_scrape, account, workers,
+                                   writer.db_get_page_cache(str(account['dcps_id'])), timeout, retries): str(account['dcps_id'])
+                   for account in accounts}
+        for future in as_completed(futures):
+            try:
+                account, results, metrics = future.result()
+                writer.metrics.merge(metrics)
+                writer.db_insert_webpage(results, account)
+            except Exception as e:     # DCPSError, a page the parser does not understand, or a database error of this account
+                print("ERROR: account {}: {}".format(futures[future], e))
+                failed.append(futures[future])
+                continue
+            if not quiet:
+                print("Account {} updated".format(account))
+    return failed
+
+
+def add_business_days(day, n):
+    '''
+    move n (positive or negative) business days from day, weekends are skipped
+    '''
+    step = 1 if n >= 0 else -1
+    while n:
+        day += timedelta(days=step)
+        if day.weekday() < 5:
+            n -= step
+    return day
+
+
+def expected_nav_date(now, nav_hour=9, nav_lag=1):
+    '''
+    the most recent NAV date that can be published at now (datetime).
+    The NAV of a business day is published nav_lag business days later, from nav_hour (local time).
+    '''
+    publication = now.date()
+    if publication.weekday() >= 5 or now.hour < nav_hour:
+        publication = add_business_days(publication, -1)
+    return add_business_days(publication, -nav_lag)
+
+
+def next_nav_publication(now, nav_hour=9):
+    '''
+    the next time (datetime) a new NAV can be published
+    '''
+    publication = now.date()
+    if publication.weekday() >= 5 or now.hour >= nav_hour:
+        publication = add_business_days(publication, 1)
+    return datetime.combine(publication, datetime.min.time()).replace(hour=nav_hour)
+
+
+async def daemon_run(scraper, writer, nav_hour=9, nav_lag=1, poll=1800, keepalive=900, max_backoff=3600, quiet=False):
+    '''
+    scrape the webpage each time a new NAV can have been published, until SIGINT or SIGTERM.
+    The scraper (without database) runs in a thread, the writer stores its results in the event loop thread.
+    Raises AuthenticationError when the portal refuses the credentials, retrying would risk locking the account.
+    '''
+    import asyncio
+    import signal
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:    # Windows
+            signal.signal(sig, lambda signum, frame: loop.call_soon_threadsafe(stop.set))
+
+    # the scraper continues from what the database knows
+    writer.page_cache = writer.db_get_page_cache()
+    scraper.page_cache = writer.page_cache     # updated in place by db_insert_webpage()
+    backoff = 0      # current wait after a failure, or between polls for a NAV published late
+    while not stop.is_set():
+        now = datetime.now()
+        expected = expected_nav_date(now, nav_hour, nav_lag)
+        latest = writer.db_get_latest_nav_date()
+        if latest and datetime.strptime(latest, "%d/%m/%Y").date() >= expected:
+            backoff = 0
+            wake = next_nav_publication(now, nav_hour)
+            if not quiet:
+                print("{:%Y-%m-%d %H:%M:%S} NAV {} is stored, no new NAV before {:%Y-%m-%d %H:%M}".format(now, latest, wake), flush=True)
+        else:
+            try:
+                scraper.webpage_main = None     # check that the session is still valid, log in again if not
+                # an update that already started is finished and written before stopping
+                results = await asyncio.to_thread(scraper.web_scrape_webpage)
+                writer.run_id = None    # each update is a run of its own in the changelog
+                writer.db_insert_webpage(results, scraper.account)
+            except AuthenticationError:
+                raise
+            except Exception as e:     # DCPSError, or a page the parser does not understand: keep running
+                backoff = min(max(2 * backoff, 60), max_backoff)
+                wake = now + timedelta(seconds=backoff)
+                print("{:%Y-%m-%d %H:%M:%S} ERROR: {}, retrying at {:%H:%M:%S}".format(now, e, wake), flush=True)
+            else:
+                latest = writer.db_get_latest_nav_date()
+                if not quiet:
+                    print("{:%Y-%m-%d %H:%M:%S} database updated, latest NAV {}".format(datetime.now(), latest), flush=True)
+                if latest and datetime.strptime(latest, "%d/%m/%Y").date() >= expected:
+                    backoff = 0
+                    continue    # the next loop computes the next publication
+                # the NAV is late (or it is a holiday): poll again, less and less often
+                backoff = min(max(2 * backoff, poll), max_backoff)
+                wake = min(now + timedelta(seconds=backoff), next_nav_publication(now, nav_hour))
+
+        # sleep until wake, checking the session now and then so it does not expire
+        while not stop.is_set():
+            left = (wake - datetime.now()).total_seconds()
+            if left <= 0:
+                break
+            try:
+                await asyncio.wait_for(stop.wait(), min(left, keepalive) if keepalive else left)
+            except asyncio.TimeoutError:
+                if keepalive and left > keepalive and scraper.webpage_main:
+                    scraper.webpage_main = None
+                    try:
+                        await asyncio.to_thread(scraper.web_login)
+                    except AuthenticationError:
+                        raise
+                    except Exception as e:     # like an update: log it and keep running
+                        # no more checks until the next update, which logs in again
+                        print("{:%Y-%m-%d %H:%M:%S} ERROR: session check: {}".format(datetime.now(), e), flush=True)
+    if not quiet:
+        print("{:%Y-%m-%d %H:%M:%S} stopped".format(datetime.now()), flush=True)
+
+
+def daemon(dcps_url, dcps_id, dcps_pwd, db_file='dcps.sqlite3.db', db_wal=False, workers=4, timeout=60, retries=3, quiet=False, **kwargs):
+    '''
+    run as a long running process that updates the database when new NAV data can exist, see daemon_run()
+    '''
+    import asyncio
+    scraper = DCPS(dcps_url, dcps_id, dcps_pwd, workers=workers, db_file=None, timeout=timeout, retries=retries)
+    writer = DCPS(None, dcps_id, None, db_file=db_file, db_wal=db_wal)
+    try:
+        asyncio.run(daemon_run(scraper, writer, quiet=quiet, **kwargs))
+    finally:
+        writer.sql_conn.close()
+
+
 if __name__ == "__main__":
+    import argparse
+    import atexit
     parser = argparse.ArgumentParser(description='Monitor and report your NATO Defined Contribution Pension Scheme holdings.')
-    # parser.add_argument('-q', '--quiet', dest='quiet', action='store_true', help='output nothing except errors. great for cronjobs (TODO)')  # TODO implement this
+    parser.add_argument('-q', '--quiet', dest='quiet', action='store_true', help='output nothing except errors, the tables are not even rendered. great for cronjobs')
     parser.add_argument('--pdf', dest='pdf', action='store_true', help='process historical Individual Statement PDFs')
+    parser.add_argument('--pdf-dir', dest='pdf_dir', help='process the Individual Statement PDFs already downloaded in this directory, without logging in')
+    parser.add_argument('--docs-dir', dest='docs_dir', default='.', help='directory where the downloaded Individual Statement PDFs are saved (default: current directory)')
     parser.add_argument('--update', dest='update', action='store_true', help='process normal yearly data (by default if no params are given)')
+    parser.add_argument('--accounts', dest='accounts', help='JSON file with the credentials of multiple accounts to update in one batch, instead of keys.py')
+    parser.add_argument('-p', '--processes', dest='processes', type=int, default=None, help='number of accounts to scrape, or PDFs to parse, in parallel (default: number of CPUs)')
+    parser.add_argument('--db', dest='db_file', default='dcps.sqlite3.db', help='path of the SQLite database (default dcps.sqlite3.db)')
+    parser.add_argument('--wal', dest='db_wal', action='store_true', help='use the SQLite WAL journal, so dashboards reading the database do not block updates')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=4, help='number of contribution detail pages to download in parallel, 1 to download sequentially (default 4)')
+    parser.add_argument('--timeout', dest='timeout', type=float, default=60, help='seconds to wait for the portal before retrying (default 60)')
+    parser.add_argument('--retries', dest='retries', type=int, default=3, help='number of retries of failed requests, with exponential backoff (default 3)')
+    parser.add_argument('--export', dest='export', choices=DCPS.EXPORT_TABLES + ['valuation'], help='export a table, or the daily valuation history, from the database without logging in')
+    parser.add_argument('--format', dest='format', choices=['csv', 'jsonl', 'parquet'], default='csv', help='format of --export (default csv, parquet needs pyarrow)')
+    parser.add_argument('-o', '--output', dest='output', help='file written by --export (default: standard output)')
+    parser.add_argument('--start', dest='start', help='only export the rows from this date (dd/mm/YYYY)')
+    parser.add_argument('--end', dest='end', help='only export the rows until this date (dd/mm/YYYY)')
+    parser.add_argument('--fund', dest='fund', help='only export the rows of this fund')
+    parser.add_argument('--metrics', dest='metrics', help='write the time, requests, bytes and rows of each phase of the run to this file')
+    parser.add_argument('--metrics-format', dest='metrics_format', choices=['json', 'prometheus'], default='json', help='format of --metrics, prometheus for the node_exporter textfile collector (default json)')
+    parser.add_argument('--profile', dest='profile', help='profile the run with cProfile and write the statistics to this file (read them with python3 -m pstats)')
+    parser.add_argument('--daemon', dest='daemon', action='store_true', help='keep running, and update the database each time a new NAV can have been published')
+    parser.add_argument('--nav-hour', dest='nav_hour', type=int, default=9, help='with --daemon: hour of the day from which the NAV of the previous business day can be published (default 9)')
+    parser.add_argument('--nav-lag', dest='nav_lag', type=int, default=1, help='with --daemon: number of business days between a NAV date and its publication (default 1)')
+    parser.add_argument('--login', dest='login', action='store_true', help='log in again instead of reusing the session of the previous run')
     # parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='extra verbosity')
 
     # --first-run or --magic -- first run, do magic: extract data, extract old data from Individual Statement PDFs and compute data based on historical fund value
-    # -f -- path for database, (default dcps.sqlite3.db)
 
     args = parser.parse_args()
 
-    dcps = DCPS(keys.dcps_url, keys.dcps_id, keys.dcps_pwd)
+    # atexit, so the reports are also written when the run ends with an error
+    if args.metrics:
+        atexit.register(dcps_metrics.METRICS.write_prometheus if args.metrics_format == 'prometheus' else dcps_metrics.METRICS.write_json, args.metrics)
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        atexit.register(profiler.dump_stats, args.profile)
+        profiler.enable()
 
-    if args.pdf:
-        dcps.web_get_documents_list()
-    else:
-        dcps.db_update_from_webpage()
-        print()
-        print("####################")
-        print("# DATABASE UPDATED #")
-        print("####################")
+    if args.export:
+        # the rows of all the accounts in the database, which must exist: opening it would create an empty one
+        if not os.path.isfile(args.db_file):
+            exit("ERROR: the database {} does not exist.".format(args.db_file))
+        try:
+            dcps = DCPS(None, None, None, db_file=args.db_file)
+            dcps.db_export(args.export, args.output, args.format, args.start, args.end, args.fund)
+        except (ImportError, ValueError, DCPSError) as e:
+            exit("ERROR: {}".format(e))
+        exit(0)
+
+    if args.accounts:
+        try:
+            failed = batch_update(load_accounts(args.accounts), args.db_file, args.processes, args.workers, args.db_wal, args.timeout, args.retries, args.quiet)
+        except DCPSError as e:
+            exit("ERROR: {}".format(e))
+        exit(1 if failed else 0)
+
+    try:
+        import keys     # only needed here, not in batch mode with an accounts file
+    except ImportError:
+        exit("ERROR: keys.py file with dcps_url, dcps_id, dcps_pwd does not exist.")
+    if args.daemon:
+        try:
+            daemon(keys.dcps_url, keys.dcps_id, keys.dcps_pwd, args.db_file, args.db_wal, args.workers, args.timeout, args.retries, args.quiet,
+                   nav_hour=args.nav_hour, nav_lag=args.nav_lag)
+        except DCPSError as e:
+            exit("ERROR: {}".format(e))
+        exit(0)
+    dcps = DCPS(keys.dcps_url, keys.dcps_id, keys.dcps_pwd, workers=args.workers, db_file=args.db_file, db_wal=args.db_wal, processes=args.processes, docs_dir=args.docs_dir,
+                timeout=args.timeout, retries=args.retries, quiet=args.quiet)
+
+    try:
+        if args.pdf_dir:
+            if dcps.db_update_from_pdf_dir(args.pdf_dir):
+                exit(1)
+        else:
+            if args.login:
+                dcps.web_login(force=True)
+            if args.pdf:
+                if dcps.web_get_documents_list():
+                    exit(1)
+            else:
+                dcps.db_update_from_webpage()
+                if not args.quiet:
+                    print()
+                    print("####################")
+                    print("# DATABASE UPDATED #")
+                    print("####################")
+    except DCPSError as e:
+        exit("ERROR: {}".format(e))
 
     # TESTING - WORK IN PROGRESS
     #
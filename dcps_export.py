@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+'''
+NATO DCPS monitoring tool - export
+@author: Christophe Vandeplas <christophe@vandeplas.com>
+@copyright: AGPLv3
+
+Writes rows to CSV, JSON Lines or Parquet files chunk by chunk, so only one chunk is ever held in memory.
+The rows come from DCPS.db_export(), as lists of tuples in the order of the columns.
+Parquet needs pyarrow, which is only imported when that format is used.
+'''
+
+import csv
+import json
+import math
+import sys
+
+FORMATS = ['csv', 'jsonl', 'parquet']
+# columns of the valuation history, with their SQLite type
+VALUATION_COLUMNS = [('account', 'text'), ('date', 'text'), ('date_unix', 'integer'), ('fund', 'text'), ('units', 'real'),
+                     ('price_per_unit', 'real'), ('value', 'real'), ('invested', 'real'), ('twr', 'real')]
+
+
+def clean(value):
+    # NaN is not valid JSON, and an empty cell in CSV
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def write_csv(chunks, columns, f):
+    writer = csv.writer(f)
+    writer.writerow([name for name, sqltype in columns])
+    count = 0
+    for rows in chunks:
+        writer.writerows([[clean(x) for x in row] for row in rows])
+        count += len(rows)
+    return count
+
+
+def write_jsonl(chunks, columns, f):
+    names = [name for name, sqltype in columns]
+    count = 0
+    for rows in chunks:
+        f.write(''.join(json.dumps(dict(zip(names, [clean(x) for x in row]))) + '\n' for row in rows))
+        count += len(rows)
+    return count
+
+
+def write_parquet(chunks, columns, fname):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("the parquet format needs pyarrow: pip3 install pyarrow")
+    # the schema comes from the column types, a chunk of only NULLs would otherwise change the type of a column
+    types = {'text': pyarrow.string(), 'integer': pyarrow.int64(), 'real': pyarrow.float64()}
+    schema = pyarrow.schema([(name, types.get(sqltype, pyarrow.string())) for name, sqltype in columns])
+    count = 0
+    # one row group per chunk
+    with pyarrow.parquet.ParquetWriter(fname, schema) as writer:
+        for rows in chunks:
+            data = list(zip(*rows))
+            writer.write_table(pyarrow.Table.from_arrays([pyarrow.array([clean(x) for x in col], type=field.type)
+                                                          for col, field in zip(data, schema)], schema=schema))
+            count += len(rows)
+    return count
+
+
+def write(chunks, columns, fname=None, fmt='csv'):
+    '''
+    write the chunks of rows of the (name, SQLite type) columns to fname, or stdout when fname is None.
+    Returns the number of rows written.
+    '''
+    if fmt not in FORMATS:
+        raise ValueError("unknown export format {}, use one of {}".format(fmt, ', '.join(FORMATS)))
+    if fmt == 'parquet':
+        if fname is None:
+            raise ValueError("the parquet format needs an output file")
+        return write_parquet(chunks, columns, fname)
+    writer = write_csv if fmt == 'csv' else write_jsonl
+    if fname is None:
+        return writer(chunks, columns, sys.stdout)
+    with open(fname, 'w', newline='') as f:
+        return writer(chunks, columns, f)
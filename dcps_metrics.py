@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+'''
+NATO DCPS monitoring tool - instrumentation
+@author: Christophe Vandeplas <christophe@vandeplas.com>
+@copyright: AGPLv3
+
+Measures per phase of a run the wall time, the CPU time, the HTTP requests, the bytes downloaded and the database rows written,
+and writes them as JSON or as a Prometheus textfile (for the node_exporter textfile collector).
+The counters are global to the process, a phase records how much they increased while it ran,
+so phases nest: a phase includes the phases it calls, and the work of the threads it started.
+'''
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+COUNTERS = ['requests', 'bytes', 'rows']
+
+
+def cpu_time():
+    # the CPU time of all threads, and of the child processes that ended (the PDF parsing pool)
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.phases = {}     # by phase name: calls, wall_seconds, cpu_seconds and the increase of the counters
+
+    def count(self, **kwargs):
+        '''
+        add to the counters, e.g. count(requests=1, bytes=len(content)). Thread safe.
+        '''
+        with self.lock:
+            for k, v in kwargs.items():
+                self.counters[k] += v
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        measure the block as a phase, the measures of the calls with the same name add up
+        '''
+        with self.lock:
+            counters = dict(self.counters)
+        wall, cpu = time.perf_counter(), cpu_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, cpu_time() - cpu
+            with self.lock:
+                p = self.phases.setdefault(name, dict({'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0}, **dict.fromkeys(COUNTERS, 0)))
+                p['calls'] += 1
+                p['wall_seconds'] += wall
+                p['cpu_seconds'] += cpu
+                for k in COUNTERS:
+                    p[k] += self.counters[k] - counters[k]
+
+    def merge(self, report):
+        '''
+        add the measures of another process, e.g. the report() of a scraper of a batch run
+        '''
+        with self.lock:
+            for k, v in report['counters'].items():
+                self.counters[k] += v
+            for name, measures in report['phases'].items():
+                p = self.phases.setdefault(name, dict.fromkeys(measures, 0))
+                for k, v in measures.items():
+                    p[k] += v
+
+    def report(self):
+        with self.lock:
+            return {'time_unix': int(time.time()), 'counters': dict(self.counters), 'phases': {k: dict(v) for k, v in self.phases.items()}}
+
+    def write_json(self, fname):
+        write_atomic(fname, json.dumps(self.report(), indent=2) + '\n')
+
+    def write_prometheus(self, fname):
+        report = self.report()
+        lines = []
+        # gauges, the file describes the last run only
+        for measure, text in [('calls', 'number of times the phase ran'),
+                              ('wall_seconds', 'wall time spent in the phase'),
+                              ('cpu_seconds', 'CPU time spent in the phase'),
+                              ('requests', 'HTTP requests sent in the phase'),
+                              ('bytes', 'bytes downloaded in the phase'),
+                              ('rows', 'database rows inserted or updated in the phase')]:
+            metric = 'dcps_phase_' + measure
+            lines.append('# HELP {} {}'.format(metric, text))
+            lines.append('# TYPE {} gauge'.format(metric))
+            for name, p in sorted(report['phases'].items()):
+                lines.append('{}{{phase="{}"}} {}'.format(metric, name, p[measure]))
+        lines.append('# HELP dcps_last_run_timestamp_seconds end of the last run')
+        lines.append('# TYPE dcps_last_run_timestamp_seconds gauge')
+        lines.append('dcps_last_run_timestamp_seconds {}'.format(report['time_unix']))
+        write_atomic(fname, '\n'.join(lines) + '\n')
+
+
+def write_atomic(fname, text):
+    # the textfile collector must never read a half written file
+    with open(fname + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(fname + '.tmp', fname)
+
+
+def timed(name):
+    '''
+    decorator measuring a DCPS method as a phase in self.metrics
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.phase(name):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+METRICS = Metrics()     # the measures of this process, shared by the DCPS instances
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+'''
+NATO DCPS monitoring tool - Individual Statement parser
+@author: Christophe Vandeplas <christophe@vandeplas.com>
+@copyright: AGPLv3
+
+Parses the text of the Holdings (DETAIL) pages, as extracted from the Individual Statement PDFs by slate,
+into typed records. The patterns are compiled once, the noise is removed with plain string operations
+and the rows are then read in a single scan, without rewriting the text in between.
+'''
+
+import re
+from collections import namedtuple
+from datetime import date
+
+Holding = namedtuple('Holding', ['operation_code', 'date', 'fund', 'total_amount', 'currency', 'amount', 'price_per_unit', 'units'])
+
+TOTAL = re.compile(r'TOTAL[0-9]{2}/[0-9]{2}/[0-9]{4}[A-Z]{3}[a-zA-Z ]+\([A-Z]{3}\)-?[0-9.]+,[0-9]{3}')
+# one row - note the last 2 columns are presented in a different way than they are visually seen on the page.
+# A row can only start at the beginning of a run of operation code characters, the lookbehind
+# prevents the regex from retrying at every character of long text runs such as the header.
+ROW = re.compile(r'(?<![a-zA-Z \(\)\*])'
+                 r'([a-zA-Z \(\)\*]+)'                  # operation code
+                 r'([0-9]{2})/([0-9]{2})/([0-9]{4})'    # date
+                 r'([A-Z]{3}[a-zA-Z ]+\([A-Z]{3}\))'    # fund (CURR)
+                 r'(-?[0-9.]+,[0-9]{2})'                # total amount
+                 r'([A-Z]{3})'                          # currency
+                 r'(-?[0-9.]+,[0-9]{2})'                # amount invested
+                 r'(-?[0-9.]+,[0-9]{3})'                # total units
+                 r'([0-9.]+,[0-9]{4})')                 # price per unit
+
+
+def european_to_float(s):
+    return float(s.replace('.', '').replace(',', '.'))
+
+
+def european_to_text(s):
+    # the former parser changed the number format of the whole line, keep doing it for the text columns
+    # so the fund names and operation codes stay identical to the ones already stored in the database
+    return s.replace('.', '').replace(',', '.')
+
+
+def remove_noise(page):
+    '''
+    remove the header line and other pollution
+    '''
+    first_line = page.find('\n')
+    if first_line < 0:
+        first_line = len(page)
+    header = page.rfind('Holdings (DETAIL)', 0, first_line)
+    if header >= 0:
+        page = page[header + len('Holdings (DETAIL)'):]
+    page = page.replace('TransactionInvestment', '').replace('\x0c', '')
+    if 'TOTAL' in page:
+        page = TOTAL.sub('', page)
+    return page
+
+
+def parse_page(page):
+    '''
+    yields the Holding records of the text of one Holdings (DETAIL) page
+    '''
+    for m in ROW.finditer(remove_noise(page)):
+        operation_code, day, month, year, fund, total_amount, currency, amount, units, price_per_unit = m.groups()
+        yield Holding(european_to_text(operation_code),
+                      date(int(year), int(month), int(day)),   # much faster than strptime
+                      european_to_text(fund),
+                      european_to_float(total_amount),
+                      currency,
+                      european_to_float(amount),
+                      european_to_float(price_per_unit),
+                      european_to_float(units))
+
+
+def parse_pages(pages):
+    '''
+    yields the Holding records of all Holdings (DETAIL) pages of a statement
+    '''
+    for page in pages:
+        if 'Holdings (DETAIL)' in page:
+            yield from parse_page(page)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+'''
+NATO DCPS monitoring tool - portfolio valuation
+@author: Christophe Vandeplas <christophe@vandeplas.com>
+@copyright: AGPLv3
+
+Daily valuation of the holdings of one account, per fund and in total.
+The transactions and prices are kept in (funds x days) NumPy arrays, from which the cumulative units,
+market value, invested capital and time-weighted returns are derived with cumulative sums and products.
+New rows only recompute the days from the earliest changed day onwards, not the whole history.
+'''
+
+import numpy as np
+
+DAY = 86400
+YEAR = 365.25
+
+
+def unix_to_day(date_unix):
+    '''
+    days since the epoch of the date_unix columns.
+    They hold local midnight (see DCPS.date_to_unix()), rounding gives the calendar day for any UTC offset under 12h.
+    '''
+    return np.rint(np.asarray(date_unix, dtype=np.float64) / DAY).astype(np.int64)
+
+
+# value of the days and funds without data, per array
+FILL = {'units_in': 0.0, 'cash_in': 0.0, 'price_obs': np.nan,
+        'units': 0.0, 'price': np.nan, 'value': 0.0, 'invested': 0.0, 'growth': 1.0,
+        'total_value': 0.0, 'total_invested': 0.0, 'total_growth': 1.0}
+
+
+class Valuation:
+    def __init__(self, capacity=366):
+        self.funds = []         # fund names, in row order of the arrays
+        self.fund_index = {}
+        self.first_day = None   # day of column 0, in days since the epoch
+        self.ndays = 0          # columns in use, the arrays grow by doubling
+        self.dirty = None       # first column to recompute, None = up to date
+        # input, one value per fund and day
+        self.units_in = None    # units bought (+) or sold (-)
+        self.cash_in = None     # gross amount invested (+) or disinvested (-)
+        self.price_obs = None   # published price per unit
+        # derived by refresh()
+        self.units = None
+        self.price = None       # last known price
+        self.value = None
+        self.invested = None
+        self.growth = None      # time-weighted growth of 1 invested
+        self.total_value = None
+        self.total_invested = None
+        self.total_growth = None
+        self._resize(0, capacity)
+
+    def _resize(self, nfunds, capacity, shift=0):
+        '''
+        reallocate the arrays for nfunds and capacity days, the existing days are moved shift columns to the right
+        '''
+        for name, fill in FILL.items():
+            old = getattr(self, name)
+            if name.startswith('total_'):
+                new = np.full(capacity, fill)
+                if old is not None:
+                    new[shift:shift + old.shape[0]] = old
+            else:
+                new = np.full((nfunds, capacity), fill)
+                if old is not None:
+                    new[:old.shape[0], shift:shift + old.shape[1]] = old
+            setattr(self, name, new)
+
+    def _grow(self, days, funds):
+        '''
+        make room for the given days (days since the epoch) and fund names, returns their column and row indices
+        '''
+        days = np.asarray(days, dtype=np.int64)
+        capacity = self.units_in.shape[1]
+        shift = 0
+        if self.first_day is None:
+            self.first_day = int(days.min())
+        elif days.min() < self.first_day:
+            # a row older than the history, the days are recomputed from there on anyway
+            shift = self.first_day - int(days.min())
+            self.first_day -= shift
+            self.ndays += shift
+        cols = days - self.first_day
+        if cols.max() >= self.ndays:
+            # the days after the former last day are not computed yet
+            self._mark(np.array([self.ndays]))
+            self.ndays = int(cols.max()) + 1
+        while self.ndays > capacity:
+            capacity *= 2
+
+        new = [f for f in dict.fromkeys(funds) if f not in self.fund_index]
+        for f in new:
+            self.fund_index[f] = len(self.funds)
+            self.funds.append(f)
+        if shift or new or capacity > self.units_in.shape[1]:
+            # the derived values of a new fund are right until its first day, like the ones of the other funds
+            self._resize(len(self.funds), capacity + shift, shift)
+        rows = np.array([self.fund_index[f] for f in funds], dtype=np.int64)
+        return cols, rows
+
+    def _mark(self, cols):
+        first = int(cols.min())
+        self.dirty = first if self.dirty is None else min(self.dirty, first)
+
+    def add_transactions(self, date_unix, funds, units, amounts, sign=1):
+        '''
+        add (sign=1) or remove (sign=-1) contributions_detail rows: operation date, fund, units and gross amount
+        '''
+        if len(funds) == 0:
+            return
+        cols, rows = self._grow(unix_to_day(date_unix), funds)
+        np.add.at(self.units_in, (rows, cols), sign * np.asarray(units, dtype=np.float64))
+        np.add.at(self.cash_in, (rows, cols), sign * np.asarray(amounts, dtype=np.float64))
+        self._mark(cols)
+
+    def add_prices(self, date_unix, funds, prices, missing_only=False):
+        '''
+        add the prices per unit of funds at their NAV dates, a later price of the same fund and day replaces the former one.
+        With missing_only the prices only fill the days without a price, e.g. the transaction price at the operation date.
+        '''
+        if len(funds) == 0:
+            return
+        cols, rows = self._grow(unix_to_day(date_unix), funds)
+        prices = np.asarray(prices, dtype=np.float64)
+        if missing_only:
+            keep = np.isnan(self.price_obs[rows, cols])
+            rows, cols, prices = rows[keep], cols[keep], prices[keep]
+            if not len(cols):
+                return
+        self.price_obs[rows, cols] = prices
+        self._mark(cols)
+
+    def add_operation_prices(self, date_unix, funds, prices):
+        '''
+        the units count from the operation date, their price only from the NAV date, often days later.
+        Until then the transaction price values them, otherwise the total would count the cash flow of a fund without its value.
+        '''
+        self.add_prices(date_unix, funds, prices, missing_only=True)
+
+    def refresh(self):
+        '''
+        recompute the derived series from the first changed day onwards, continuing from the state of the day before
+        '''
+        if self.dirty is None:
+            return self
+        s, e = self.dirty, self.ndays
+        nfunds = len(self.funds)
+        if s > 0:
+            units0, invested0, price0 = self.units[:, s - 1], self.invested[:, s - 1], self.price[:, s - 1]
+            value0, growth0 = self.value[:, s - 1], self.growth[:, s - 1]
+            total_value0, total_growth0 = self.total_value[s - 1], self.total_growth[s - 1]
+        else:
+            units0, invested0, price0 = np.zeros(nfunds), np.zeros(nfunds), np.full(nfunds, np.nan)
+            value0, growth0 = np.zeros(nfunds), np.ones(nfunds)
+            total_value0, total_growth0 = 0.0, 1.0
+
+        units = units0[:, None] + np.cumsum(self.units_in[:, s:e], axis=1)
+        invested = invested0[:, None] + np.cumsum(self.cash_in[:, s:e], axis=1)
+        # forward fill the prices: index of the last known price of every day, column 0 being the day before
+        prices = np.concatenate([price0[:, None], self.price_obs[:, s:e]], axis=1)
+        last = np.where(np.isnan(prices), 0, np.arange(e - s + 1))
+        np.maximum.accumulate(last, axis=1, out=last)
+        price = np.take_along_axis(prices, last, axis=1)[:, 1:]
+        # no units means no value, even before the first known price
+        value = np.where(units == 0, 0.0, units * price)
+
+        # time-weighted return of a day: (value - cash flow of the day) / value of the day before
+        cash = self.cash_in[:, s:e]
+        before = np.concatenate([value0[:, None], value[:, :-1]], axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(before > 0, (value - cash) / before, 1.0)
+        growth = growth0[:, None] * np.cumprod(np.nan_to_num(ratio, nan=1.0), axis=1)
+
+        total_value = np.nansum(value, axis=0)
+        total_before = np.concatenate([[total_value0], total_value[:-1]])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            total_ratio = np.where(total_before > 0, (total_value - cash.sum(axis=0)) / total_before, 1.0)
+        total_growth = total_growth0 * np.cumprod(np.nan_to_num(total_ratio, nan=1.0))
+
+        self.units[:, s:e], self.invested[:, s:e], self.price[:, s:e], self.value[:, s:e], self.growth[:, s:e] = units, invested, price, value, growth
+        self.total_value[s:e], self.total_invested[s:e], self.total_growth[s:e] = total_value, invested.sum(axis=0), total_growth
+        self.dirty = None
+        return self
+
+    def apply_rows(self, table, rows, old_rows=()):
+        '''
+        take into account rows (dicts of the database columns) written to a table,
+        old_rows are the former values of updated rows and are taken out first. The series are recomputed lazily.
+        '''
+        if table == 'contributions_detail':
+            for sign, data in [(-1, old_rows), (1, rows)]:
+                self.add_transactions([x['date_operation_unix'] for x in data], [x['fund'] for x in data],
+                                      [x['units'] for x in data], [x['amount_gross'] for x in data], sign)
+            self.add_prices([x['date_nav_unix'] for x in rows], [x['fund'] for x in rows], [x['price_per_unit'] for x in rows])
+            self.add_operation_prices([x['date_operation_unix'] for x in rows], [x['fund'] for x in rows], [x['price_per_unit'] for x in rows])
+        elif table in ['balance_now', 'balance_year']:
+            self.add_prices([x['date_unix'] for x in rows], [x['fund'] for x in rows], [x['price_per_unit'] for x in rows])
+        return self
+
+    def dates(self):
+        '''
+        the days of the series, as numpy datetime64[D]
+        '''
+        if self.first_day is None:
+            return np.array([], dtype='datetime64[D]')
+        return np.arange(self.first_day, self.first_day + self.ndays).astype('datetime64[D]')
+
+    def series(self, fund=None):
+        '''
+        dict of the daily arrays of one fund, or of the total when fund is None.
+        twr is the cumulative time-weighted return since the start.
+        '''
+        self.refresh()
+        e = self.ndays
+        if fund is None:
+            return {'date': self.dates(), 'value': self.total_value[:e], 'invested': self.total_invested[:e],
+                    'twr': self.total_growth[:e] - 1}
+        i = self.fund_index[fund]
+        return {'date': self.dates(), 'units': self.units[i, :e], 'price': self.price[i, :e], 'value': self.value[i, :e],
+                'invested': self.invested[i, :e], 'twr': self.growth[i, :e] - 1}
+
+    def twr(self, fund=None, start=None, end=None):
+        '''
+        time-weighted return between two dates (datetime64 or 'YYYY-MM-DD', default the whole history), not annualised
+        '''
+        self.refresh()
+        growth = self.total_growth if fund is None else self.growth[self.fund_index[fund]]
+        s, e = self._columns(start, end)
+        before = growth[s - 1] if s > 0 else 1.0
+        return growth[e] / before - 1
+
+    def mwr(self, fund=None, start=None, end=None):
+        '''
+        money-weighted return (internal rate of return) between two dates, default the whole history.
+        The value at start counts as an investment on that day and the value at end as the final withdrawal.
+        Annualised for periods of a year or more, the return over the period for shorter ones:
+        annualising a few days would blow any move up to absurd rates.
+        Returns a float per fund, or for the total, nan when it does not converge.
+        '''
+        self.refresh()
+        s, e = self._columns(start, end)
+        if fund is None:
+            cash = self.cash_in[:, s:e + 1].sum(axis=0)
+            value = self.total_value
+        else:
+            i = self.fund_index[fund]
+            cash = self.cash_in[i, s:e + 1]
+            value = self.value[i]
+        value_start = value[s - 1] if s > 0 else 0.0
+        rate = float(irr(cash[None, :], np.array([value_start]), np.array([value[e]]))[0])
+        # the time from the first flow to the end, like irr() counts it
+        flows = np.flatnonzero(np.concatenate([[value_start], cash]))
+        years = (len(cash) - flows[0]) / YEAR if len(flows) else 0.0
+        return rate if years >= 1 else (1 + rate) ** years - 1
+
+    def _columns(self, start, end):
+        s = 0 if start is None else max(0, int(np.datetime64(start, 'D').astype(np.int64)) - self.first_day)
+        e = self.ndays - 1 if end is None else min(self.ndays - 1, int(np.datetime64(end, 'D').astype(np.int64)) - self.first_day)
+        if e < 0 or s > e:
+            # a negative column would silently index from the end of the arrays
+            raise ValueError("no day of the valuation between {} and {}".format(start, end))
+        return s, e
+
+
+def irr(cash, value_start, value_end, iterations=100, tolerance=1e-10):
+    '''
+    annualised internal rate of return of several series at once, solved with Newton's method.
+    cash: (series x days) daily amounts invested, value_start is invested the day before the first day
+    and value_end withdrawn on the last day.
+    '''
+    days = cash.shape[1]
+    flows = np.concatenate([value_start[:, None], cash], axis=1)
+    years = (days - 1 - np.arange(-1, days)) / YEAR     # time from each flow to the last day
+    # only the days with a flow matter, a few per month over decades of daily columns
+    keep = np.any(flows != 0, axis=0)
+    flows, years = flows[:, keep], years[keep]
+    rate = np.full(flows.shape[0], 0.05)
+    step = np.full(flows.shape[0], np.nan)
+    for _ in range(iterations):
+        growth = (1 + rate)[:, None] ** years
+        f = (flows * growth).sum(axis=1) - value_end
+        df = (flows * years * growth / (1 + rate)[:, None]).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = f / df
+        rate = np.maximum(rate - step, -0.9999)
+        if np.all(np.abs(step) < tolerance):
+            break
+    return np.where(np.abs(step) < tolerance, rate, np.nan)
+
+
+def from_rows(transactions, prices, valuation=None):
+    '''
+    build a Valuation from database rows:
+    transactions: (date_operation_unix, date_nav_unix, fund, units, amount_gross, price_per_unit)
+    prices: (date_unix, fund, price_per_unit)
+    '''
+    valuation = valuation or Valuation()
+    if transactions:
+        date_operation, date_nav, funds, units, amounts, transaction_prices = zip(*transactions)
+        valuation.add_transactions(date_operation, funds, units, amounts)
+        valuation.add_prices(date_nav, funds, transaction_prices)
+    if prices:
+        date, price_funds, price = zip(*prices)
+        valuation.add_prices(date, price_funds, price)
+    if transactions:
+        # after the published prices, which take precedence
+        valuation.add_operation_prices(date_operation, funds, transaction_prices)
+    return valuation.refresh()